@@ -26,10 +26,12 @@
 #ifndef __PRENDO_H__
 #define __PRENDO_H__
 
+#include <cstdint>
 #include <memory>
 #include <vector>
 #include <algorithm>
 #include <tuple>
+#include <strings.h>
 #include "cocos2d.h"
 #include "cocos-ext.h"
 #if (CC_TARGET_PLATFORM == CC_PLATFORM_IOS)
@@ -78,6 +80,16 @@ struct ScoreEntry {
 	, _location(""){
 	}
 	
+	ScoreEntry( std::string name, std::string comment, long points,
+		std::string control, long date, std::string location )
+	: _name(name)
+	, _comment(comment)
+	, _points(points)
+	, _date( date )
+	, _control(control)
+	, _location(location){
+	}
+	
 	picojson::value toJSON() {
 		std::map<std::string, picojson::value> map = {
 			{"name", picojson::value(_name)},
@@ -93,6 +105,72 @@ struct ScoreEntry {
 typedef std::shared_ptr<std::vector<ScoreEntry>> pvse;
 typedef std::tuple<pvse, pvse, pvse> tup;
 
+// Reads the varints and strings of the compact list format, see compact.py on
+// the server. Reading past the end gives zeroes and clears ok.
+class CompactReader {
+	const unsigned char* _pos;
+	const unsigned char* _end;
+	
+public:
+	bool ok;
+	
+	CompactReader(const char* data, size_t size)
+	: _pos( reinterpret_cast< const unsigned char* >( data ) )
+	, _end( _pos + size )
+	, ok( true ) {
+	}
+	
+	uint64_t readVarint() {
+		uint64_t value = 0;
+		for(int shift = 0; shift < 64; shift += 7) {
+			if(_pos >= _end) {
+				ok = false;
+				return 0;
+			}
+			unsigned char c = *_pos++;
+			value |= uint64_t( c & 0x7f ) << shift;
+			if(c < 0x80) {
+				return value;
+			}
+		}
+		ok = false;
+		return 0;
+	}
+	
+	int64_t readSigned() {
+		uint64_t value = readVarint();
+		return ( value & 1 ) ? -int64_t( value >> 1 ) - 1
+			: int64_t( value >> 1 );
+	}
+	
+	std::string readString() {
+		uint64_t size = readVarint();
+		if(size > uint64_t( _end - _pos )) {
+			ok = false;
+			return "";
+		}
+		std::string s( reinterpret_cast< const char* >( _pos ), size );
+		_pos += size;
+		return s;
+	}
+	
+	// Like readString, but without copying, for skipping over a list.
+	const char* readBytes(size_t* size) {
+		*size = readVarint();
+		if(*size > size_t( _end - _pos )) {
+			ok = false;
+			*size = 0;
+		}
+		auto bytes = reinterpret_cast< const char* >( _pos );
+		_pos += *size;
+		return bytes;
+	}
+	
+	bool atEnd() {
+		return _pos >= _end;
+	}
+};
+
 class Scores {
 	static void sortScores(std::vector<ScoreEntry>& s) {
 		std::sort( s.begin(), s.end(), [] ( const ScoreEntry & lhs,
@@ -101,12 +179,14 @@ class Scores {
 		});
 	}
 	
-	static tup handleRequest(picojson::value response_value) {
+	// Lists the response leaves out, because the tag sent for them is still
+	// current, come back as nullptr. The tags of the lists are put in tags.
+	static tup handleRequest(picojson::value response_value,
+			std::vector<std::string>* tags) {
 		auto response_obj = response_value.get<picojson::object>();
 		auto request_obj = response_obj["request"].get<picojson::object>();
 		
-		const std::string LOCATION_WORLD = "location_world";
-		const std::string LOCATION_WEEK = "location_week";
+		readTags(request_obj, tags);
 		
 		// TODO : handle control maybe
 		//auto control = request_obj["control"].get<std::string>();
@@ -118,36 +198,170 @@ class Scores {
 		pvse newWeek = nullptr;
 		
 		for(auto& v : requestData) {
-			auto list_string = v.get<std::string>();
-			auto list_v = jsonParse(list_string);
+			// Unchanged since the tag sent in the request.
+			if(v.is<picojson::null>()) {
+				continue;
+			}
+			
+			// From protocol version 2 on the lists are json objects, before
+			// that strings holding them.
+			auto list_v = v;
+			if(v.is<std::string>()) {
+				list_v = jsonParse(v.get<std::string>());
+			}
 			auto list_obj = list_v.get<picojson::object>();
 			auto listLocation = list_obj["location"].get<std::string>();
 			auto listScores = list_obj["scores"].get<picojson::array>();
 			
 			auto s = extractScores(listScores);
 			
-			sortScores( s );
-			
-			// TODO case insensitive compare?
-			if(listLocation == LOCATION_WORLD) {
-				std::vector< ScoreEntry > * kaka =
-					new std::vector< ScoreEntry >( s );
-				newWorld.reset( kaka );
+			setList(listLocation, s, newWorld, newNational, newWeek);
+		}
+		
+		return std::make_tuple(newWorld, newNational, newWeek);
+	}
+	
+	static void readTags(picojson::object& request_obj,
+			std::vector<std::string>* tags) {
+		if(tags && request_obj["tags"].is<picojson::array>()) {
+			tags->clear();
+			for(auto& t : request_obj["tags"].get<picojson::array>()) {
+				tags->push_back(t.is<std::string>() ?
+					t.get<std::string>() : "");
+			}
+		}
+	}
+	
+	static void setList(const std::string& listLocation,
+			std::vector<ScoreEntry>& s, pvse& newWorld, pvse& newNational,
+			pvse& newWeek) {
+		const std::string LOCATION_WORLD = "location_world";
+		const std::string LOCATION_WEEK = "location_week";
+		
+		sortScores( s );
+		
+		// TODO case insensitive compare?
+		if(listLocation == LOCATION_WORLD) {
+			std::vector< ScoreEntry > * kaka =
+				new std::vector< ScoreEntry >( s );
+			newWorld.reset( kaka );
+		}
+		// TODO case insensitive compare?
+		else if(listLocation == LOCATION_WEEK) {
+			newWeek.reset( new std::vector< ScoreEntry >( s ) );
+		}
+		// Two character country code.
+		else if(listLocation.length() == 2){
+			newNational.reset( new std::vector< ScoreEntry >( s ) );
+		}
+	}
+	
+	// Decodes one list of the compact format, see compact.py on the server.
+	// Returns false if the list is cut short or refers to missing strings.
+	static bool extractCompactScores(const char* data, size_t size,
+			std::string* location, std::vector<ScoreEntry>* scores) {
+		CompactReader r( data, size );
+		
+		// Every string takes at least a byte.
+		size_t stringCount = r.readVarint();
+		if(stringCount > size) {
+			return false;
+		}
+		std::vector<std::string> strings( stringCount );
+		for(auto& string : strings) {
+			string = r.readString();
+		}
+		auto locationIndex = r.readVarint();
+		size_t count = r.readVarint();
+		if(!r.ok || locationIndex >= strings.size() || count > size) {
+			return false;
+		}
+		*location = strings[locationIndex];
+		
+		std::vector<long> points( count );
+		std::vector<long> dates( count );
+		// The first points and date, then differences to the previous ones.
+		for(size_t i = 0; i < count; ++i) {
+			long d = r.readSigned();
+			points[i] = i > 0 ? points[i - 1] - d : d;
+		}
+		for(size_t i = 0; i < count; ++i) {
+			long d = r.readSigned();
+			dates[i] = i > 0 ? dates[i - 1] + d : d;
+		}
+		// Names, comments, controls and locations.
+		std::vector<uint64_t> indexes( count * 4 );
+		for(auto& index : indexes) {
+			index = r.readVarint();
+			if(index >= strings.size()) {
+				return false;
 			}
-			// TODO case insensitive compare?
-			else if(listLocation == LOCATION_WEEK) {
-				newWeek.reset( new std::vector< ScoreEntry >( s ) );
+		}
+		if(!r.ok) {
+			return false;
+		}
+		
+		scores->clear();
+		scores->reserve( count );
+		for(size_t i = 0; i < count; ++i) {
+			scores->push_back(ScoreEntry(strings[indexes[i]],
+				strings[indexes[count + i]], points[i],
+				strings[indexes[2 * count + i]], dates[i],
+				strings[indexes[3 * count + i]]));
+		}
+		return true;
+	}
+	
+public:
+	// First bytes of a response in the compact format, which is asked for
+	// in prepareData.
+	static bool isCompact(const std::vector<char>& response) {
+		const std::string COMPACT_RESPONSE_MAGIC = "PRC1";
+		return response.size() >= COMPACT_RESPONSE_MAGIC.size()
+			&& std::equal(COMPACT_RESPONSE_MAGIC.begin(),
+				COMPACT_RESPONSE_MAGIC.end(), response.begin());
+	}
+	
+	// Like handleJson, for a response in the compact format: the magic, the
+	// response without its data as json, and then the lists, each prefixed
+	// with its size, which is 0 for lists left out.
+	static tup handleCompact(const std::vector<char>& response,
+			std::vector<std::string>* tags = nullptr) {
+		pvse newWorld = nullptr;
+		pvse newNational = nullptr;
+		pvse newWeek = nullptr;
+		
+		CompactReader r( response.data() + 4, response.size() - 4 );
+		
+		size_t headerSize = 0;
+		auto header = r.readBytes(&headerSize);
+		if(!r.ok) {
+			return std::make_tuple(newWorld, newNational, newWeek);
+		}
+		auto response_obj = jsonParse(std::string(header, headerSize));
+		if(response_obj.is<picojson::object>()) {
+			readTags(response_obj.get<picojson::object>(), tags);
+		}
+		
+		auto listCount = r.readVarint();
+		for(uint64_t i = 0; i < listCount && r.ok; ++i) {
+			size_t size = 0;
+			auto data = r.readBytes(&size);
+			// Unchanged since the tag sent in the request.
+			if(size == 0) {
+				continue;
 			}
-			// Two character country code.
-			else if(listLocation.length() == 2){
-				newNational.reset( new std::vector< ScoreEntry >( s ) );
+			
+			std::string listLocation;
+			std::vector<ScoreEntry> s;
+			if(extractCompactScores(data, size, &listLocation, &s)) {
+				setList(listLocation, s, newWorld, newNational, newWeek);
 			}
 		}
 		
 		return std::make_tuple(newWorld, newNational, newWeek);
 	}
 	
-public:
 	static picojson::value jsonParse(std::string s) {
 		auto json = s.c_str();
 		std::string error;
@@ -168,9 +382,35 @@ public:
 		
 		return to_return;
 	}
-	static tup handleJson(std::string json) {
+	static tup handleJson(std::string json,
+			std::vector<std::string>* tags = nullptr) {
 		
-		return handleRequest(jsonParse(json));
+		return handleRequest(jsonParse(json), tags);
+	}
+	
+	// Value of the last ETag header in the raw headers of a response, the
+	// last since redirects add the headers of every response, or an empty
+	// string if there is none.
+	static std::string responseETag(const std::vector<char>& headers) {
+		const std::string NAME = "etag:";
+		std::string raw(headers.begin(), headers.end());
+		std::string etag;
+		size_t start = 0;
+		while(start < raw.size()) {
+			auto end = raw.find('\n', start);
+			if(end == std::string::npos) {
+				end = raw.size();
+			}
+			auto line = raw.substr(start, end - start);
+			if(strncasecmp(line.c_str(), NAME.c_str(), NAME.size()) == 0) {
+				auto first = line.find_first_not_of(" \t", NAME.size());
+				auto last = line.find_last_not_of(" \t\r");
+				etag = first == std::string::npos ? ""
+					: line.substr(first, last - first + 1);
+			}
+			start = end + 1;
+		}
+		return etag;
 	}
 };
 
@@ -179,13 +419,24 @@ class ScoreManager : public cocos2d::CCObject {
 	pvse _world;
 	pvse _national;
 	pvse _week;
+	// Tags of the national, world and week lists, in the order of the
+	// response data, see prepareData.
+	std::vector<std::string> _tags;
+	// Country of the national list, sent with reads, see readUrl.
+	std::string _country;
+	// Whether the request in progress is a read, see readUrl.
+	bool _readInProgress;
+	// ETag of the read response the current lists are from, empty if they
+	// are from a post. It's a hash of the body, so reads send it back as
+	// If-None-Match and the server answers 304 if the lists are the same.
+	std::string _etag;
 	bool _refreshInProgress;
 	std::vector<ScoreEntry> _submitQueue;
 	std::vector<ScoreEntry> _submitQueueInProgress;
 
 	std::function< void() > _refreshCompleteCallback;
 	
-	ScoreManager() : _refreshInProgress( false ) {
+	ScoreManager() : _readInProgress( false ), _refreshInProgress( false ) {
 		auto s = cocos2d::CCUserDefault::sharedUserDefault()->getStringForKey(
 			"__prendo_saved_scores" );
 		if (s != "") {
@@ -198,7 +449,13 @@ class ScoreManager : public cocos2d::CCObject {
 		cocos2d::extension::CCHttpResponse *response =
 			static_cast< cocos2d::extension::CCHttpResponse * >( data );
 		
-		if (!response || !response->isSucceed())
+		// Nothing has changed since the read of _etag, keep the lists. Not
+		// every version of the http client counts a 304 as a success.
+		bool notModified = response && response->getResponseCode() == 304;
+		auto wasRead = _readInProgress;
+		_readInProgress = false;
+		
+		if (!notModified && (!response || !response->isSucceed()))
 		{
 			_refreshInProgress = false;
 			for(auto& se : _submitQueueInProgress) {
@@ -210,21 +467,34 @@ class ScoreManager : public cocos2d::CCObject {
 		
 		std::vector<char>* v = response->getResponseData();
 		
-		std::string str(v->begin(),v->end());
-		
-		auto t = Scores::handleJson(str);
-		auto scoresWorld = std::get<0>(t);
-		auto scoresNational = std::get<1>(t);
-		auto scoresWeek= std::get<2>(t);
-		
-		if (scoresWorld)
-			_world = scoresWorld;
-		
-		if (scoresNational)
-			_national = scoresNational;
-		
-		if (scoresWeek)
-			_week = scoresWeek;
+		// An empty body has no lists either, keep the current ones.
+		if (!notModified && !v->empty()) {
+			tup t;
+			if(Scores::isCompact(*v)) {
+				t = Scores::handleCompact(*v, &_tags);
+			} else {
+				std::string str(v->begin(),v->end());
+				t = Scores::handleJson(str, &_tags);
+			}
+			auto scoresWorld = std::get<0>(t);
+			auto scoresNational = std::get<1>(t);
+			auto scoresWeek= std::get<2>(t);
+			
+			if (scoresWorld)
+				_world = scoresWorld;
+			
+			if (scoresNational) {
+				_national = scoresNational;
+				if (!_national->empty())
+					_country = _national->front()._location;
+			}
+			
+			if (scoresWeek)
+				_week = scoresWeek;
+			
+			_etag = wasRead
+				? Scores::responseETag(*response->getResponseHeader()) : "";
+		}
 		
 		_refreshInProgress = false;
 		_submitQueueInProgress.clear();
@@ -233,12 +503,41 @@ class ScoreManager : public cocos2d::CCObject {
 		_refreshCompleteCallback();
 	}
 	
+	// A read without anything to submit can be a GET, which the server and
+	// proxies between can answer from their caches. The country makes the
+	// URL the same for all players of it.
+	std::string readUrl(const std::string& urlBase,
+			const std::string& control) {
+		std::string url = urlBase + "?control=" + control
+			+ "&version=3&format=compact";
+		if (!_country.empty()) {
+			url += "&country=" + _country;
+		}
+		return url;
+	}
+	
 	std::string prepareData(std::string control) {
 		const std::string SECRET_SUBMIT_CODE = "<SECRET SUBMIT CODE HERE>";
+		// Protocol version understood by Scores::handleRequest.
+		const double PROTOCOL_VERSION = 3;
 		picojson::object json_request = {
-			{"control", picojson::value(control)}
+			{"control", picojson::value(control)},
+			{"version", picojson::value(PROTOCOL_VERSION)},
+			// Lists as Scores::handleCompact reads them, which is a lot
+			// smaller and faster to read than json.
+			{"format", picojson::value(std::string("compact"))}
 		};
 		
+		// Only send the tags of lists we still have, the server leaves
+		// those out if they haven't changed.
+		if(_national && _world && _week && _tags.size() == 3) {
+			picojson::array json_tags;
+			for(auto& tag : _tags) {
+				json_tags.push_back(picojson::value(tag));
+			}
+			json_request["tags"] = picojson::value(json_tags);
+		}
+		
 		picojson::array json_scores_array;
 		for(auto& e : _submitQueueInProgress) {
 			json_scores_array.push_back(e.toJSON());
@@ -310,13 +609,32 @@ public:
 			_submitQueue.clear();
 			
 			auto request = new cocos2d::extension::CCHttpRequest();
-			request->setRequestType(
-				cocos2d::extension::CCHttpRequest::kHttpPost );
 			{
 				using namespace cocos2d;
 				request->setResponseCallback(this,
 					callfuncND_selector(ScoreManager::onHttpRequestCompleted));
 			}
+			
+			if ( _submitQueueInProgress.empty() ) {
+				auto url = readUrl(URL_REQ_AND_SUB, control);
+				request->setRequestType(
+					cocos2d::extension::CCHttpRequest::kHttpGet );
+				request->setUrl(url.c_str());
+				if (!_etag.empty() && _national && _world && _week) {
+					std::vector<std::string> headers;
+					headers.push_back("If-None-Match: " + _etag);
+					request->setHeaders(headers);
+				}
+				_readInProgress = true;
+				cocos2d::extension::CCHttpClient::getInstance()->send(request);
+				request->release();
+				
+				CCLOG( "ScoreManager: read %s sent.", url.c_str() );
+				return;
+			}
+			
+			request->setRequestType(
+				cocos2d::extension::CCHttpRequest::kHttpPost );
 			request->setUrl(URL_REQ_AND_SUB.c_str());
 			
 			auto s = prepareData(control);
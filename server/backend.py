@@ -0,0 +1,261 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Storage and cache layer used by Score, Country and the handlers.
+
+Everything that touches the datastore or memcache goes through the Backend
+returned by get(). On App Engine that is backend_appengine.AppEngineBackend,
+elsewhere (load tests, profiling) backend_local.LocalBackend can be installed
+with use().
+
+"""
+
+import datetime
+
+try:
+	from google.appengine.runtime import DeadlineExceededError
+except ImportError:
+	class DeadlineExceededError( Exception ):
+		"""Stand-in for the App Engine request deadline outside of App
+		Engine. Nothing raises it, it only keeps the except clauses valid."""
+
+# Return values of Backend.cache_delete, same as memcache.delete.
+CACHE_DELETE_FAILED = 0
+CACHE_DELETE_MISSING = 1
+CACHE_DELETE_SUCCESSFUL = 2
+
+_EPOCH = datetime.datetime( 1970, 1, 1 )
+
+_backend = None
+
+def use( backend ):
+	"""Install backend as the one returned by get()."""
+	global _backend
+	_backend = backend
+
+def get():
+	"""Return the active backend, defaulting to the App Engine one."""
+	global _backend
+	if _backend is None:
+		from backend_appengine import AppEngineBackend
+		_backend = AppEngineBackend()
+	return _backend
+
+def day_number( date ):
+	"""Return the number of the day of the datetime date, counted in days
+	since 1970-01-01."""
+	return ( date - _EPOCH ).days
+
+def day_start( day ):
+	"""Return the datetime the day with number day starts at."""
+	return _EPOCH + datetime.timedelta( days=day )
+
+
+class Backend( object ):
+	"""Interface for the score store, the country store and the cache.
+	
+	Scores are passed in and out as score.Score objects. Backends set
+	Score.key when a score is stored and use it to find the stored copy
+	again when updating or deleting it.
+	
+	Scores are kept apart by their Score.board, the control and game mode of
+	their leaderboard. Backends store it as the control of the score, which
+	is what it was before there were game modes, and keep the scores of each
+	board apart so that the boards don't slow each other down.
+	
+	"""
+	
+	#
+	# Scores
+	#
+	
+	def top_scores( self, count, board, location ):
+		"""Return at most count scores of the board and location, a country
+		code, ordered by descending points. The world list is merged from the
+		country lists and the week list built with recent_top_scores."""
+		raise NotImplementedError
+	
+	def top_scores_multi( self, count, board, locations ):
+		"""Return a list with the top_scores of each of the locations.
+		Backends that can should run the queries in parallel."""
+		return [ self.top_scores( count, board, location )
+			for location in locations ]
+	
+	def recent_top_scores( self, count, board, since ):
+		"""Return the at most count scores of board with the most points of
+		each day, see day_number, from the one of the datetime since until
+		today, leaving out the ones dated before since. In no particular
+		order, and costing a query per day rather than reading every score
+		since since."""
+		raise NotImplementedError
+	
+	def query_scores( self, board=None, location=None, new_week=None,
+			points_below=None, date_before=None, date_after=None, order=None,
+			limit=1000 ):
+		"""Return at most limit scores matching all the given filters. order
+		is a property name, prefixed with "-" for descending order."""
+		raise NotImplementedError
+	
+	def query_scores_page( self, cursor=None, board=None, location=None,
+			new_week=None, points_below=None, date_before=None,
+			date_after=None, order=None, limit=100 ):
+		"""Like query_scores, but starting after cursor, which is a string
+		returned by an earlier call with the same filters or None to start at
+		the beginning. Return a tuple ( scores, cursor ) with a cursor for the
+		next page, which is None when there are no more scores.
+		
+		Changing or deleting scores of earlier pages doesn't move later
+		pages, even if that makes them stop matching the filters.
+		
+		"""
+		raise NotImplementedError
+	
+	def nth_points( self, board, location, n ):
+		"""Return the points of the n:th best score of board and location,
+		a country code or config.LOCATION_WORLD, counting from 1, or None if
+		there are fewer than n. One query that skips the better scores
+		without reading them."""
+		raise NotImplementedError
+	
+	def insert_scores( self, scores ):
+		"""Store the new scores that aren't already stored, as told by
+		Score.identity, and return a list of whether each one was. Backends
+		only have to look among the scores stored together with scores from
+		the same location."""
+		raise NotImplementedError
+	
+	def put_personal_bests( self, scores ):
+		"""Store each of the scores, all of boards that keep personal bests,
+		unless the stored score with the same Score.identity, which is the
+		best of the player, has at least as many points. Each score is one
+		keyed read-modify-write, atomic with other writes of the same key.
+		Return a list with a tuple ( whether it was stored, the score it
+		replaced or None ) for each of the scores."""
+		raise NotImplementedError
+	
+	def put_scores( self, scores ):
+		"""Store scores, replacing stored ones with the same identity, and
+		write back changes to stored ones."""
+		raise NotImplementedError
+	
+	def delete_scores( self, scores ):
+		raise NotImplementedError
+	
+	def migrate_scores( self, limit ):
+		"""Move at most limit scores stored the way older versions did to
+		where they are stored now. Return the number moved, 0 when done."""
+		raise NotImplementedError
+	
+	#
+	# Rank histograms, see histogram.PointsHistogram
+	#
+	
+	def add_to_histograms( self, board, location, points, count=1 ):
+		"""Count the list of points count times in the histogram of location
+		and in the one of config.LOCATION_WORLD, -1 to take them back."""
+		raise NotImplementedError
+	
+	def clear_histograms( self, board, locations ):
+		"""Forget what was counted in the histograms of board of each of the
+		locations and of config.LOCATION_WORLD."""
+		raise NotImplementedError
+	
+	def histogram( self, board, location ):
+		"""Return the PointsHistogram of location, which is a country code or
+		config.LOCATION_WORLD. An empty one if nothing was counted yet."""
+		raise NotImplementedError
+	
+	#
+	# Countries
+	#
+	
+	def save_country( self, location ):
+		"""Remember location, doing nothing if it is already known."""
+		raise NotImplementedError
+	
+	def all_countries( self ):
+		"""Return a list of all saved locations, sorted."""
+		raise NotImplementedError
+	
+	#
+	# Tasks
+	#
+	
+	def enqueue_tasks( self, url, params ):
+		"""Queue a request to url for each dict of request parameters in the
+		list params, to be run in parallel on config.MAINTENANCE_QUEUE."""
+		raise NotImplementedError
+	
+	#
+	# Cache, with memcache semantics: values are copies, and time is an
+	# expiry in seconds where 0 means no expiry.
+	#
+	
+	def cache_get( self, key ):
+		raise NotImplementedError
+	
+	def cache_get_multi( self, keys ):
+		"""Return a dict with the found keys and their values."""
+		raise NotImplementedError
+	
+	def cache_set( self, key, value, time=0 ):
+		raise NotImplementedError
+	
+	def cache_set_multi( self, mapping, time=0 ):
+		"""Return a list of the keys that could not be set."""
+		raise NotImplementedError
+	
+	def cache_add( self, key, value, time=0 ):
+		"""Set key only if it is not already set. Return whether it was."""
+		raise NotImplementedError
+	
+	def cache_add_multi( self, mapping, time=0 ):
+		"""Like cache_add for many keys. Return a list of the keys that were
+		not set."""
+		raise NotImplementedError
+	
+	def cache_gets_multi( self, keys ):
+		"""Like cache_get_multi, but remembers the values' versions so that a
+		following cache_cas_multi of the keys from the same thread only sets
+		the ones nobody else changed in between."""
+		raise NotImplementedError
+	
+	def cache_cas_multi( self, mapping, time=0 ):
+		"""Set the keys that are unchanged since cache_gets_multi. Return a
+		list of the keys that were not set."""
+		raise NotImplementedError
+	
+	def cache_delete( self, key ):
+		"""Return one of the CACHE_DELETE_* values."""
+		raise NotImplementedError
+	
+	def cache_delete_multi( self, keys ):
+		"""Return whether all keys were deleted or missing."""
+		raise NotImplementedError
+	
+	def cache_incr( self, key, delta=1, initial_value=None ):
+		"""Return the new value, or None if key isn't set and initial_value
+		is None."""
+		raise NotImplementedError
+	
+	def cache_flush( self ):
+		raise NotImplementedError
@@ -0,0 +1,505 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+import datetime
+import itertools
+import random
+import threading
+import zlib
+
+import backend
+import config
+from histogram import PointsHistogram
+from score import Score
+
+class Scorelist( db.Model ):
+	"""Entity group parent of scores. Scorelists are never stored, their keys
+	only group scores so that list queries can be ancestor queries and thus
+	strongly consistent on the High Replication datastore.
+	
+	An entity group takes about one write per second, so scores are spread
+	over config.SCORE_SHARD_COUNT groups per board, picked by location.
+	Scores stored before that all share the single legacy group.
+	
+	On boards that keep personal bests the group is picked by player
+	instead, so that a player's best stays under the same key wherever it
+	is submitted from. Their location lists then query all the groups.
+	
+	"""
+	
+	@classmethod
+	def single_key( cls ):
+		"""Return the key of the legacy group."""
+		return db.Key.from_path( "Scorelist", "all_scores" )
+	
+	@classmethod
+	def shard_key( cls, board, location ):
+		"""Return the key of the group for scores of board and location.
+		Any other string picks a group just as well."""
+		shard = zlib.crc32( location.encode( "utf-8" ) ) & 0xffffffff
+		shard %= config.SCORE_SHARD_COUNT
+		return db.Key.from_path( "Scorelist", "%s:%d" % ( board, shard ) )
+	
+	@classmethod
+	def score_key( cls, score ):
+		"""Return the key of the group for a new score."""
+		if Score.keeps_personal_bests( score.board ):
+			return cls.shard_key( score.board, score.player )
+		return cls.shard_key( score.board, score.location )
+	
+	@classmethod
+	def has_legacy( cls, board ):
+		"""Return whether the legacy group can hold scores of board, which
+		it only does for the boards there were before game modes."""
+		return config.READ_LEGACY_SCORES \
+			and Score.split_board( board )[1] == config.DEFAULT_GAME_MODE
+	
+	@classmethod
+	def location_keys( cls, board, location ):
+		"""Return the keys of the groups that can hold scores of board and
+		location."""
+		if Score.keeps_personal_bests( board ):
+			return cls.board_keys( board )
+		
+		keys = [ cls.shard_key( board, location ) ]
+		if cls.has_legacy( board ):
+			keys.append( cls.single_key() )
+		return keys
+	
+	@classmethod
+	def shard_keys( cls, board ):
+		"""Return the keys of all the groups of board but the legacy one."""
+		return [ db.Key.from_path( "Scorelist", "%s:%d" % ( board, shard ) )
+			for shard in range( config.SCORE_SHARD_COUNT ) ]
+	
+	@classmethod
+	def board_keys( cls, board ):
+		"""Return the keys of the groups that can hold scores of board."""
+		keys = cls.shard_keys( board )
+		if cls.has_legacy( board ):
+			keys.append( cls.single_key() )
+		return keys
+
+
+class ScoreModel( db.Model ):
+	name = db.StringProperty( required=True, multiline=False )
+	comment = db.StringProperty( multiline=False, default="" )
+	points = db.IntegerProperty( required=True )
+	control = db.StringProperty( required=True, multiline=False )
+	location = db.StringProperty( required=True, multiline=False )
+	date = db.DateTimeProperty( auto_now_add=True )
+	new_week = db.BooleanProperty( required=True, default=True )
+	player_id = db.StringProperty( multiline=False, indexed=False )
+	# backend.day_number of date, see recent_top_scores. Scores stored before
+	# there was one get it from cronjob?set_score_days=yes.
+	day = db.IntegerProperty()
+	
+	@classmethod
+	def kind( cls ):
+		# Keep using the entity kind from before the backend split.
+		return "Score"
+	
+	@classmethod
+	def from_score( cls, score ):
+		# New scores are keyed by their identity, making a put of a score
+		# that is already stored a harmless overwrite.
+		if score.key is None:
+			return ScoreModel( key_name=score.identity(),
+				name=score.name,
+				comment=score.comment,
+				points=score.points,
+				control=score.board,
+				location=score.location,
+				date=score.date,
+				day=backend.day_number( score.date ),
+				new_week=score.new_week,
+				player_id=score.player_id,
+				parent=Scorelist.score_key( score ) )
+		else:
+			return ScoreModel( name=score.name,
+				comment=score.comment,
+				points=score.points,
+				control=score.board,
+				location=score.location,
+				date=score.date,
+				day=backend.day_number( score.date ),
+				new_week=score.new_week,
+				player_id=score.player_id,
+				key=score.key )
+	
+	def to_score( self ):
+		control, game_mode = Score.split_board( self.control )
+		return Score( name=self.name,
+			comment=self.comment,
+			points=self.points,
+			control=control,
+			game_mode=game_mode,
+			location=self.location,
+			date=self.date,
+			new_week=self.new_week,
+			player_id=self.player_id,
+			key=self.key() )
+
+
+class RankHistogram( db.Model ):
+	"""Stored histogram.PointsHistogram. The histogram of a board and a
+	location, or config.LOCATION_WORLD, is split into
+	config.RANK_HISTOGRAM_SHARDS shards, each the root of its own entity
+	group. Counting scores writes to a random shard of their location and one
+	of the world, so counts contend neither with each other nor with the
+	score groups."""
+	tree = db.BlobProperty( required=True )
+	
+	@classmethod
+	def shard_key( cls, board, location, shard ):
+		return db.Key.from_path( "RankHistogram", "%s:%s:%d" % ( board,
+			location, shard ) )
+	
+	@classmethod
+	def shard_keys( cls, board, location ):
+		return [ cls.shard_key( board, location, shard )
+			for shard in range( config.RANK_HISTOGRAM_SHARDS ) ]
+
+
+class CountryModel( db.Model ):
+	location = db.StringProperty( required=True, multiline=False )
+	
+	@classmethod
+	def kind( cls ):
+		return "Country"
+
+
+class AppEngineBackend( backend.Backend ):
+	"""Datastore and memcache backend."""
+	
+	def __init__( self ):
+		# memcache.Client keeps the cas ids from gets, so use one per thread.
+		self._local = threading.local()
+	
+	def _client( self ):
+		client = getattr( self._local, "client", None )
+		if client is None:
+			client = memcache.Client()
+			self._local.client = client
+		return client
+	
+	def _list_query( self, group, board, location ):
+		return ScoreModel.all().ancestor( group ) \
+			.filter( "control =", board ) \
+			.filter( "location =", location ) \
+			.order( "-points" )
+	
+	def _start_recent_top_scores( self, count, board, since ):
+		"""Start the queries for recent_top_scores and return their runs."""
+		# The datastore can't order the scores of a date range by points, but
+		# it can the ones of a day. These span all groups, like _score_query.
+		runs = []
+		first_day = backend.day_number( since )
+		for day in range( first_day,
+				backend.day_number( datetime.datetime.now() ) + 1 ):
+			query = ScoreModel.all() \
+				.filter( "control =", board ) \
+				.filter( "day =", day ) \
+				.order( "-points" )
+			if day > first_day:
+				runs.append( query.run( limit=count, batch_size=count ) )
+				continue
+			
+			# Only the first day has scores from before since, which may be
+			# the best of it, so read on until count of them are after since.
+			runs.append( itertools.islice( ( model for model
+				in query.run( batch_size=count ) if model.date > since ),
+				count ) )
+		return runs
+	
+	def _start_top_scores( self, count, board, location ):
+		"""Start the queries for top_scores and return their runs."""
+		groups = Scorelist.location_keys( board, location )
+		
+		# Query.run sends the first batch request right away, the results are
+		# only waited for when the run is iterated.
+		return [ self._list_query( group, board, location ).run(
+			limit=count, batch_size=count ) for group in groups ]
+	
+	def _merge_top_scores( self, count, runs ):
+		"""Merge the per group top lists of runs."""
+		merged = []
+		for run in runs:
+			merged.extend( run )
+		merged.sort( key=lambda model: -model.points )
+		
+		return [ model.to_score() for model in merged[:count] ]
+	
+	def top_scores( self, count, board, location ):
+		return self.top_scores_multi( count, board, [ location ] )[0]
+	
+	def top_scores_multi( self, count, board, locations ):
+		# Start all the queries before reading any of them so that they run
+		# in parallel.
+		started = [ self._start_top_scores( count, board, location )
+			for location in locations ]
+		return [ self._merge_top_scores( count, runs ) for runs in started ]
+	
+	def recent_top_scores( self, count, board, since ):
+		scores = []
+		for run in self._start_recent_top_scores( count, board, since ):
+			scores.extend( model.to_score() for model in run )
+		return scores
+	
+	def _score_query( self, board, location, new_week, points_below,
+			date_before, date_after, order ):
+		# Not an ancestor query since it spans all groups. Only maintenance
+		# and the pages below the top lists use it, so eventual consistency
+		# is fine.
+		scores = ScoreModel.all()
+		
+		if board is not None:
+			scores = scores.filter( "control =", board )
+		if location is not None:
+			scores = scores.filter( "location =", location )
+		if new_week is not None:
+			scores = scores.filter( "new_week =", new_week )
+		if points_below is not None:
+			scores = scores.filter( "points <", points_below )
+		if date_before is not None:
+			scores = scores.filter( "date <", date_before )
+		if date_after is not None:
+			scores = scores.filter( "date >", date_after )
+		if order is not None:
+			scores = scores.order( order )
+		
+		return scores
+	
+	def query_scores( self, board=None, location=None, new_week=None,
+			points_below=None, date_before=None, date_after=None, order=None,
+			limit=1000 ):
+		scores = self._score_query( board, location, new_week,
+			points_below, date_before, date_after, order )
+		return [ model.to_score() for model in scores.fetch( limit ) ]
+	
+	def query_scores_page( self, cursor=None, board=None, location=None,
+			new_week=None, points_below=None, date_before=None,
+			date_after=None, order=None, limit=100 ):
+		scores = self._score_query( board, location, new_week,
+			points_below, date_before, date_after, order )
+		if cursor is not None:
+			scores.with_cursor( cursor )
+		
+		models = scores.fetch( limit )
+		if len( models ) < limit:
+			next_cursor = None
+		else:
+			next_cursor = scores.cursor()
+		return [ model.to_score() for model in models ], next_cursor
+	
+	def nth_points( self, board, location, n ):
+		query = db.Query( ScoreModel, projection=( "points", ) ) \
+			.filter( "control =", board )
+		if location != config.LOCATION_WORLD:
+			query = query.filter( "location =", location )
+		model = query.order( "-points" ).get( offset=n - 1 )
+		if model is None:
+			return None
+		return model.points
+	
+	def _legacy_exists( self, score ):
+		"""Return whether score is in the legacy group, which is keyed by
+		ids rather than identities and so needs a query."""
+		scores = ScoreModel.all( keys_only=True ) \
+			.ancestor( Scorelist.single_key() ) \
+			.filter( "name =", score.name ) \
+			.filter( "comment =", score.comment ) \
+			.filter( "points =", score.points ) \
+			.filter( "control =", score.board )
+		return scores.get() is not None
+	
+	def insert_scores( self, scores ):
+		models = [ ScoreModel.from_score( score ) for score in scores ]
+		keys = [ model.key() for model in models ]
+		stored = db.get( keys )
+		
+		inserted = []
+		to_put = []
+		seen = set()
+		for score, model, key, existing in zip( scores, models, keys,
+				stored ):
+			is_new = existing is None and not key in seen
+			if is_new and Scorelist.has_legacy( score.board ):
+				is_new = not self._legacy_exists( score )
+			seen.add( key )
+			
+			inserted.append( is_new )
+			if is_new:
+				score.key = key
+				to_put.append( model )
+		
+		if to_put:
+			db.put( to_put )
+		
+		return inserted
+	
+	def put_personal_bests( self, scores ):
+		def put_if_better( model, points ):
+			stored = db.get( model.key() )
+			if stored is not None and stored.points >= points:
+				return False, None
+			model.put()
+			return True, stored
+		
+		results = []
+		for score in scores:
+			model = ScoreModel.from_score( score )
+			was_stored, replaced = db.run_in_transaction( put_if_better,
+				model, score.points )
+			if was_stored:
+				score.key = model.key()
+			if replaced is not None:
+				replaced = replaced.to_score()
+			results.append( ( was_stored, replaced ) )
+		return results
+	
+	def put_scores( self, scores ):
+		models = [ ScoreModel.from_score( score ) for score in scores ]
+		keys = db.put( models )
+		for score, key in zip( scores, keys ):
+			score.key = key
+	
+	def delete_scores( self, scores ):
+		db.delete( [ score.key for score in scores ] )
+	
+	def migrate_scores( self, limit ):
+		if not config.READ_LEGACY_SCORES:
+			return 0
+		
+		legacy = ScoreModel.all().ancestor( Scorelist.single_key() ) \
+			.fetch( limit )
+		
+		# Put the moved copies before deleting the originals, a failure in
+		# between leaves duplicates for delete_duplicates rather than losing
+		# scores.
+		moved = []
+		for model in legacy:
+			score = model.to_score()
+			score.key = None
+			moved.append( ScoreModel.from_score( score ) )
+		db.put( moved )
+		db.delete( legacy )
+		
+		return len( legacy )
+	
+	def add_to_histograms( self, board, location, points, count=1 ):
+		def add( keys ):
+			models = db.get( keys )
+			for i, model in enumerate( models ):
+				if model is None:
+					histogram = PointsHistogram()
+				else:
+					histogram = PointsHistogram.loads( model.tree )
+				for score_points in points:
+					histogram.add( score_points, count )
+				models[i] = RankHistogram( key=keys[i],
+					tree=db.Blob( histogram.dumps() ) )
+			db.put( models )
+		
+		# Pick other shards, up to three times, if the transaction keeps
+		# colliding.
+		options = db.create_transaction_options( xg=True )
+		for attempt in range( 3 ):
+			keys = [ RankHistogram.shard_key( board, location,
+				random.randrange( config.RANK_HISTOGRAM_SHARDS ) ),
+				RankHistogram.shard_key( board, config.LOCATION_WORLD,
+				random.randrange( config.RANK_HISTOGRAM_SHARDS ) ) ]
+			try:
+				db.run_in_transaction_options( options, add, keys )
+				return
+			except db.TransactionFailedError:
+				if attempt == 2:
+					raise
+	
+	def clear_histograms( self, board, locations ):
+		keys = []
+		for location in list( locations ) + [ config.LOCATION_WORLD ]:
+			keys.extend( RankHistogram.shard_keys( board, location ) )
+		db.delete( keys )
+	
+	def histogram( self, board, location ):
+		keys = RankHistogram.shard_keys( board, location )
+		
+		histogram = PointsHistogram()
+		for model in db.get( keys ):
+			if model is not None:
+				histogram.merge( PointsHistogram.loads( model.tree ) )
+		return histogram
+	
+	def save_country( self, location ):
+		CountryModel.get_or_insert( location, location=location )
+	
+	def all_countries( self ):
+		fetched = CountryModel.all().order( "location" ).fetch( 1000 )
+		return [ country.location for country in fetched ]
+	
+	def enqueue_tasks( self, url, params ):
+		queue = taskqueue.Queue( config.MAINTENANCE_QUEUE )
+		tasks = [ taskqueue.Task( url=url, params=task_params )
+			for task_params in params ]
+		# A queue takes at most 100 tasks per add.
+		for i in range( 0, len( tasks ), 100 ):
+			queue.add( tasks[i:i + 100] )
+	
+	def cache_get( self, key ):
+		return memcache.get( key )
+	
+	def cache_get_multi( self, keys ):
+		return memcache.get_multi( keys )
+	
+	def cache_set( self, key, value, time=0 ):
+		return memcache.set( key, value, time=time )
+	
+	def cache_set_multi( self, mapping, time=0 ):
+		return memcache.set_multi( mapping, time=time )
+	
+	def cache_add( self, key, value, time=0 ):
+		return memcache.add( key, value, time=time )
+	
+	def cache_add_multi( self, mapping, time=0 ):
+		return memcache.add_multi( mapping, time=time )
+	
+	def cache_gets_multi( self, keys ):
+		return self._client().get_multi( keys, for_cas=True )
+	
+	def cache_cas_multi( self, mapping, time=0 ):
+		return self._client().cas_multi( mapping, time=time )
+	
+	def cache_delete( self, key ):
+		return memcache.delete( key )
+	
+	def cache_delete_multi( self, keys ):
+		return memcache.delete_multi( keys )
+	
+	def cache_incr( self, key, delta=1, initial_value=None ):
+		return memcache.incr( key, delta=delta, initial_value=initial_value )
+	
+	def cache_flush( self ):
+		return memcache.flush_all()
@@ -0,0 +1,549 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""SQLite and in-process cache stand-in for the App Engine backend.
+
+Lets ras and cronjob run under a plain WSGI server on one machine, see
+local_server.py.
+
+"""
+
+from cStringIO import StringIO
+import cPickle as pickle
+import datetime
+import json
+import logging
+import Queue
+import sqlite3
+import threading
+import time
+import urllib
+
+import backend
+import config
+from histogram import PointsHistogram
+from score import Score
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS score (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	identity TEXT NOT NULL UNIQUE,
+	name TEXT NOT NULL,
+	comment TEXT NOT NULL DEFAULT '',
+	points INTEGER NOT NULL,
+	control TEXT NOT NULL,
+	location TEXT NOT NULL,
+	date TIMESTAMP NOT NULL,
+	new_week INTEGER NOT NULL DEFAULT 1,
+	player_id TEXT
+);
+CREATE INDEX IF NOT EXISTS score_location
+	ON score ( control, location, points DESC );
+CREATE INDEX IF NOT EXISTS score_recent ON score ( control, date );
+CREATE INDEX IF NOT EXISTS score_date ON score ( date );
+CREATE TABLE IF NOT EXISTS histogram (
+	control TEXT NOT NULL,
+	location TEXT NOT NULL,
+	tree BLOB NOT NULL,
+	PRIMARY KEY ( control, location )
+);
+CREATE TABLE IF NOT EXISTS country (
+	location TEXT PRIMARY KEY
+);
+"""
+
+_SCORE_COLUMNS = "id, name, comment, points, control, location, date, " \
+	+ "new_week, player_id"
+
+# Properties query_scores can order by.
+_ORDER_COLUMNS = ( "points", "date", "name", "location" )
+
+
+class MemoryCache( object ):
+	"""Process local cache with the memcache semantics the code relies on.
+	Values are pickled so callers get copies, like from memcache."""
+	
+	def __init__( self ):
+		# key -> ( pickled value, expiry time or None, version )
+		self._values = {}
+		self._lock = threading.Lock()
+		self._version = 0
+		# Versions seen by gets, per thread.
+		self._seen = threading.local()
+	
+	def _expiry( self, seconds ):
+		if seconds:
+			return time.time() + seconds
+		return None
+	
+	def _live( self, key ):
+		"""Return the entry of key or None. Call with the lock held."""
+		entry = self._values.get( key )
+		if entry is None:
+			return None
+		if entry[1] is not None and entry[1] <= time.time():
+			del self._values[key]
+			return None
+		return entry
+	
+	def _store( self, key, data, expires ):
+		"""Call with the lock held."""
+		self._version += 1
+		self._values[key] = ( data, expires, self._version )
+	
+	def get( self, key ):
+		with self._lock:
+			entry = self._live( key )
+		if entry is None:
+			return None
+		return pickle.loads( entry[0] )
+	
+	def get_multi( self, keys ):
+		found = {}
+		with self._lock:
+			for key in keys:
+				entry = self._live( key )
+				if entry is not None:
+					found[key] = entry[0]
+		return dict( ( key, pickle.loads( data ) )
+			for key, data in found.iteritems() )
+	
+	def gets_multi( self, keys ):
+		if not hasattr( self._seen, "versions" ):
+			self._seen.versions = {}
+		found = {}
+		with self._lock:
+			for key in keys:
+				entry = self._live( key )
+				if entry is None:
+					self._seen.versions.pop( key, None )
+				else:
+					self._seen.versions[key] = entry[2]
+					found[key] = entry[0]
+		return dict( ( key, pickle.loads( data ) )
+			for key, data in found.iteritems() )
+	
+	def set( self, key, value, seconds=0 ):
+		data = pickle.dumps( value, pickle.HIGHEST_PROTOCOL )
+		with self._lock:
+			self._store( key, data, self._expiry( seconds ) )
+		return True
+	
+	def cas_multi( self, mapping, seconds=0 ):
+		seen = getattr( self._seen, "versions", {} )
+		not_set = []
+		for key, value in mapping.iteritems():
+			version = seen.pop( key, None )
+			data = pickle.dumps( value, pickle.HIGHEST_PROTOCOL )
+			with self._lock:
+				entry = self._live( key )
+				if version is None or entry is None or entry[2] != version:
+					not_set.append( key )
+				else:
+					self._store( key, data, self._expiry( seconds ) )
+		return not_set
+	
+	def add( self, key, value, seconds=0 ):
+		data = pickle.dumps( value, pickle.HIGHEST_PROTOCOL )
+		with self._lock:
+			if self._live( key ) is not None:
+				return False
+			self._store( key, data, self._expiry( seconds ) )
+		return True
+	
+	def delete( self, key ):
+		with self._lock:
+			if self._live( key ) is None:
+				return backend.CACHE_DELETE_MISSING
+			del self._values[key]
+		return backend.CACHE_DELETE_SUCCESSFUL
+	
+	def incr( self, key, delta, initial_value ):
+		with self._lock:
+			entry = self._live( key )
+			if entry is None:
+				if initial_value is None:
+					return None
+				value = initial_value + delta
+				expires = None
+			else:
+				value = pickle.loads( entry[0] ) + delta
+				expires = entry[1]
+			# Memcache counters never go below zero.
+			value = max( value, 0 )
+			self._store( key, pickle.dumps( value ), expires )
+		return value
+	
+	def flush( self ):
+		with self._lock:
+			self._values.clear()
+		return True
+
+
+class TaskQueue( object ):
+	"""Stand-in for an App Engine push queue: worker threads POST the queued
+	requests to application, a WSGI application that has to be set before
+	tasks are added. Failed tasks are logged, not retried."""
+	
+	def __init__( self, workers ):
+		self.application = None
+		self._workers = workers
+		self._tasks = Queue.Queue()
+		self._started = False
+		self._lock = threading.Lock()
+	
+	def _start( self ):
+		with self._lock:
+			if self._started:
+				return
+			for i in range( self._workers ):
+				worker = threading.Thread( target=self._work )
+				worker.daemon = True
+				worker.start()
+			self._started = True
+	
+	def _work( self ):
+		while True:
+			url, params = self._tasks.get()
+			try:
+				self._run( url, params )
+			except Exception, e:
+				logging.error( "TaskQueue: Task %s %s failed: %s", url,
+					params, repr( e ) )
+			finally:
+				self._tasks.task_done()
+	
+	def _run( self, url, params ):
+		body = urllib.urlencode( params )
+		environ = {
+			"REQUEST_METHOD": "POST",
+			"SCRIPT_NAME": "",
+			"PATH_INFO": url,
+			"QUERY_STRING": "",
+			"CONTENT_TYPE": "application/x-www-form-urlencoded",
+			"CONTENT_LENGTH": str( len( body ) ),
+			"SERVER_NAME": "localhost",
+			"SERVER_PORT": "80",
+			"SERVER_PROTOCOL": "HTTP/1.0",
+			"HTTP_X_APPENGINE_QUEUENAME": config.MAINTENANCE_QUEUE,
+			"wsgi.version": ( 1, 0 ),
+			"wsgi.url_scheme": "http",
+			"wsgi.input": StringIO( body ),
+			"wsgi.errors": StringIO(),
+			"wsgi.multithread": True,
+			"wsgi.multiprocess": False,
+			"wsgi.run_once": False,
+		}
+		
+		status = []
+		def start_response( response_status, headers, exc_info=None ):
+			status.append( response_status )
+		
+		for chunk in self.application( environ, start_response ):
+			pass
+		if not status[0].startswith( "2" ):
+			logging.error( "TaskQueue: Task %s %s got %s", url, params,
+				status[0] )
+	
+	def add( self, url, params ):
+		self._start()
+		self._tasks.put( ( url, params ) )
+	
+	def join( self ):
+		"""Wait until all the queued tasks are done."""
+		self._tasks.join()
+
+
+class LocalBackend( backend.Backend ):
+	"""SQLite score and country store with a MemoryCache and a TaskQueue.
+	Set task_queue.application for tasks to run."""
+	
+	def __init__( self, path=":memory:", workers=4 ):
+		self._db = sqlite3.connect( path,
+			detect_types=sqlite3.PARSE_DECLTYPES,
+			check_same_thread=False )
+		self._db.executescript( _SCHEMA )
+		self._lock = threading.RLock()
+		self._cache = MemoryCache()
+		self.task_queue = TaskQueue( workers )
+	
+	def _execute( self, sql, params=() ):
+		with self._lock:
+			cursor = self._db.execute( sql, params )
+			rows = cursor.fetchall()
+			self._db.commit()
+		return rows
+	
+	def _to_score( self, row ):
+		control, game_mode = Score.split_board( row[4] )
+		return Score( key=row[0],
+			name=row[1],
+			comment=row[2],
+			points=row[3],
+			control=control,
+			game_mode=game_mode,
+			location=row[5],
+			date=row[6],
+			new_week=bool( row[7] ),
+			player_id=row[8] )
+	
+	def top_scores( self, count, board, location ):
+		return self.query_scores( board=board, location=location,
+			order="-points", limit=count )
+	
+	def recent_top_scores( self, count, board, since ):
+		scores = []
+		for day in range( backend.day_number( since ),
+				backend.day_number( datetime.datetime.now() ) + 1 ):
+			scores.extend( self.query_scores( board=board,
+				date_after=max( since, backend.day_start( day )
+					- datetime.timedelta( microseconds=1 ) ),
+				date_before=backend.day_start( day + 1 ), order="-points",
+				limit=count ) )
+		return scores
+	
+	def query_scores( self, board=None, location=None, new_week=None,
+			points_below=None, date_before=None, date_after=None, order=None,
+			limit=1000 ):
+		return self.query_scores_page( board=board, location=location,
+			new_week=new_week, points_below=points_below,
+			date_before=date_before, date_after=date_after, order=order,
+			limit=limit )[0]
+	
+	def query_scores_page( self, cursor=None, board=None, location=None,
+			new_week=None, points_below=None, date_before=None,
+			date_after=None, order=None, limit=100 ):
+		where = []
+		params = []
+		for clause, value in ( ( "control = ?", board ),
+				( "location = ?", location ),
+				( "new_week = ?", new_week ),
+				( "points < ?", points_below ),
+				( "date < ?", date_before ),
+				( "date > ?", date_after ) ):
+			if value is not None:
+				where.append( clause )
+				params.append( value )
+		
+		# Break ties in insertion order like the datastore does by key. The
+		# cursor is the sort values of the last score, so pages continue
+		# after it even when earlier scores change.
+		column = "id"
+		direction = "ASC"
+		if order is not None:
+			column = order.lstrip( "-" )
+			if not column in _ORDER_COLUMNS:
+				raise ValueError( "Can't order by \"%s\"" % order )
+			if order.startswith( "-" ):
+				direction = "DESC"
+		
+		if cursor is not None:
+			last_value, last_id = json.loads( cursor )
+			compare = "<" if direction == "DESC" else ">"
+			where.append( "( %s %s ? OR ( %s = ? AND id > ? ) )" % ( column,
+				compare, column ) )
+			params.extend( [ last_value, last_value, last_id ] )
+		
+		sql = "SELECT %s FROM score" % _SCORE_COLUMNS
+		if where:
+			sql += " WHERE " + " AND ".join( where )
+		sql += " ORDER BY %s %s, id LIMIT ?" % ( column, direction )
+		params.append( limit )
+		
+		scores = [ self._to_score( row ) for row in self._execute( sql,
+			params ) ]
+		if len( scores ) < limit:
+			return scores, None
+		
+		last = scores[-1]
+		if column == "id":
+			last_value = last.key
+		else:
+			last_value = getattr( last, column )
+		if isinstance( last_value, datetime.datetime ):
+			# The way sqlite3 stores them, so that they compare the same.
+			last_value = last_value.isoformat( " " )
+		return scores, json.dumps( [ last_value, last.key ] )
+	
+	def nth_points( self, board, location, n ):
+		where = "control = ?"
+		params = [ board ]
+		if location != config.LOCATION_WORLD:
+			where += " AND location = ?"
+			params.append( location )
+		rows = self._execute( ( "SELECT points FROM score WHERE %s " \
+			+ "ORDER BY points DESC LIMIT 1 OFFSET ?" ) % where,
+			params + [ n - 1 ] )
+		if not rows:
+			return None
+		return rows[0][0]
+	
+	def _insert( self, score, conflict ):
+		"""Insert score, resolving identity conflicts the conflict way.
+		Return whether it was inserted. Call with the lock held."""
+		cursor = self._db.execute( ( "INSERT OR %s INTO score ( identity, " \
+			+ "name, comment, points, control, location, date, new_week, " \
+			+ "player_id ) VALUES ( ?, ?, ?, ?, ?, ?, ?, ?, ? )" ) % conflict,
+			( score.identity(), score.name, score.comment, score.points,
+			score.board, score.location, score.date,
+			int( score.new_week ), score.player_id ) )
+		if cursor.rowcount != 1:
+			return False
+		score.key = cursor.lastrowid
+		return True
+	
+	def insert_scores( self, scores ):
+		with self._lock:
+			inserted = [ self._insert( score, "IGNORE" ) for score in scores ]
+			self._db.commit()
+		return inserted
+	
+	def _update( self, score ):
+		"""Write score over the stored score with its key. Call with the
+		lock held."""
+		self._db.execute( "UPDATE score SET identity = ?, name = ?, " \
+			+ "comment = ?, points = ?, control = ?, location = ?, " \
+			+ "date = ?, new_week = ?, player_id = ? WHERE id = ?",
+			( score.identity(), score.name, score.comment, score.points,
+			score.board, score.location, score.date, int( score.new_week ),
+			score.player_id, score.key ) )
+	
+	def put_personal_bests( self, scores ):
+		results = []
+		with self._lock:
+			for score in scores:
+				rows = self._db.execute( ( "SELECT %s FROM score " \
+					+ "WHERE identity = ?" ) % _SCORE_COLUMNS,
+					( score.identity(), ) ).fetchall()
+				if not rows:
+					self._insert( score, "IGNORE" )
+					results.append( ( True, None ) )
+					continue
+				
+				best = self._to_score( rows[0] )
+				if best.points >= score.points:
+					results.append( ( False, None ) )
+					continue
+				
+				score.key = best.key
+				self._update( score )
+				results.append( ( True, best ) )
+			self._db.commit()
+		return results
+	
+	def put_scores( self, scores ):
+		with self._lock:
+			for score in scores:
+				if score.key is None:
+					self._insert( score, "REPLACE" )
+				else:
+					self._update( score )
+			self._db.commit()
+	
+	def delete_scores( self, scores ):
+		with self._lock:
+			self._db.executemany( "DELETE FROM score WHERE id = ?",
+				[ ( score.key, ) for score in scores ] )
+			self._db.commit()
+	
+	def migrate_scores( self, limit ):
+		# There is only one way of storing scores here.
+		return 0
+	
+	def add_to_histograms( self, board, location, points, count=1 ):
+		with self._lock:
+			for histogram_location in ( location, config.LOCATION_WORLD ):
+				histogram = self.histogram( board, histogram_location )
+				for score_points in points:
+					histogram.add( score_points, count )
+				self._db.execute( "INSERT OR REPLACE INTO histogram ( " \
+					+ "control, location, tree ) VALUES ( ?, ?, ? )",
+					( board, histogram_location,
+					sqlite3.Binary( histogram.dumps() ) ) )
+			self._db.commit()
+	
+	def clear_histograms( self, board, locations ):
+		locations = list( locations ) + [ config.LOCATION_WORLD ]
+		self._execute( ( "DELETE FROM histogram WHERE control = ? " \
+			+ "AND location IN ( %s )" ) % ", ".join( "?" * len( locations ) ),
+			[ board ] + locations )
+	
+	def histogram( self, board, location ):
+		rows = self._execute( "SELECT tree FROM histogram " \
+			+ "WHERE control = ? AND location = ?", ( board, location ) )
+		if not rows:
+			return PointsHistogram()
+		return PointsHistogram.loads( str( rows[0][0] ) )
+	
+	def save_country( self, location ):
+		self._execute( "INSERT OR IGNORE INTO country ( location ) " \
+			+ "VALUES ( ? )", ( location, ) )
+	
+	def all_countries( self ):
+		rows = self._execute( "SELECT location FROM country " \
+			+ "ORDER BY location" )
+		return [ row[0] for row in rows ]
+	
+	def enqueue_tasks( self, url, params ):
+		for task_params in params:
+			self.task_queue.add( url, task_params )
+	
+	def cache_get( self, key ):
+		return self._cache.get( key )
+	
+	def cache_get_multi( self, keys ):
+		return self._cache.get_multi( keys )
+	
+	def cache_set( self, key, value, time=0 ):
+		return self._cache.set( key, value, time )
+	
+	def cache_set_multi( self, mapping, time=0 ):
+		for key, value in mapping.iteritems():
+			self._cache.set( key, value, time )
+		return []
+	
+	def cache_add( self, key, value, time=0 ):
+		return self._cache.add( key, value, time )
+	
+	def cache_add_multi( self, mapping, time=0 ):
+		return [ key for key, value in mapping.iteritems()
+			if not self._cache.add( key, value, time ) ]
+	
+	def cache_gets_multi( self, keys ):
+		return self._cache.gets_multi( keys )
+	
+	def cache_cas_multi( self, mapping, time=0 ):
+		return self._cache.cas_multi( mapping, time )
+	
+	def cache_delete( self, key ):
+		return self._cache.delete( key )
+	
+	def cache_delete_multi( self, keys ):
+		for key in keys:
+			self._cache.delete( key )
+		return True
+	
+	def cache_incr( self, key, delta=1, initial_value=None ):
+		return self._cache.incr( key, delta, initial_value )
+	
+	def cache_flush( self ):
+		return self._cache.flush()
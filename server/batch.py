@@ -0,0 +1,137 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Resumable batch updates of stored scores, for maintenance cron jobs."""
+
+import logging
+import time
+
+import backend
+from backend import DeadlineExceededError
+import config
+
+class BatchUpdate( object ):
+	"""Walks the scores matching a query page by page with cursors, lets a
+	function change each page and puts the changed scores of a page with
+	one batch put, or deletes the scores it picks with one batch delete.
+	
+	After each page the cursor is checkpointed in the cache under the name of
+	the update. A run that is cut short, by the request deadline for one,
+	leaves the checkpoint behind and the next run with the same name picks up
+	after the last finished page, with the filters of the interrupted run.
+	The update function should make a page that is done twice harmless,
+	since a page may be redone if a run stops between its put and its
+	checkpoint.
+	
+	"""
+	
+	def __init__( self, name, query, update,
+			page_size=config.BATCH_PAGE_SIZE, delete=False ):
+		"""name - Identifies the checkpoint, one per kind of update.
+		query - A dict of the Backend.query_scores_page filters for a new
+			run, including order.
+		update - A function that is given the list of scores of a page,
+			changes them and returns a list of the ones to put.
+		page_size - The number of scores per page.
+		delete - Delete the scores update returns instead of putting them.
+			They don't have to be from the current page.
+		"""
+		self.name = name
+		self.query = query
+		self.update = update
+		self.page_size = page_size
+		self.delete = delete
+		self._verb = "deleted" if delete else "put"
+	
+	def _checkpoint_key( self ):
+		return "batch:%s" % self.name
+	
+	def _checkpoint( self ):
+		"""Return the ( query, cursor ) of the run to resume, or None."""
+		checkpoint = backend.get().cache_get( self._checkpoint_key() )
+		# Checkpoints of older versions may use other filters.
+		if checkpoint is None \
+				or sorted( checkpoint[0] ) != sorted( self.query ):
+			return None
+		return checkpoint
+	
+	def resuming( self ):
+		"""Return whether run would resume an interrupted run rather than
+		start a new one."""
+		return self._checkpoint() is not None
+	
+	def run( self ):
+		"""Run or resume the update until there are no more pages. Return
+		the number of scores put or deleted by this run. A DeadlineExceededError is
+		passed on once the progress is logged."""
+		
+		checkpoint_key = self._checkpoint_key()
+		checkpoint = self._checkpoint()
+		if checkpoint is None:
+			query, cursor = self.query, None
+		else:
+			query, cursor = checkpoint
+			logging.info( "BatchUpdate %s: Resuming an earlier run.",
+				self.name )
+		
+		pages = 0
+		read = 0
+		written = 0
+		start = time.time()
+		try:
+			while True:
+				scores, cursor = backend.get().query_scores_page(
+					cursor=cursor, limit=self.page_size, **query )
+				
+				to_write = self.update( scores )
+				if len( to_write ) > 0 and self.delete:
+					backend.get().delete_scores( to_write )
+				elif len( to_write ) > 0:
+					backend.get().put_scores( to_write )
+				
+				pages += 1
+				read += len( scores )
+				written += len( to_write )
+				
+				if cursor is None:
+					break
+				backend.get().cache_set( checkpoint_key, ( query, cursor ),
+					time=config.BATCH_CHECKPOINT_TIME )
+				
+				elapsed = max( time.time() - start, 0.001 )
+				logging.info( "BatchUpdate %s: %d pages, %d scores read, %d " \
+					+ "%s, %.1f scores/s.", self.name, pages, read, written,
+					self._verb, read / elapsed )
+		except DeadlineExceededError:
+			logging.warning( "BatchUpdate %s: Out of time after %d pages, " \
+				+ "%d scores read and %d %s. The next run resumes there.",
+				self.name, pages, read, written, self._verb )
+			raise
+		
+		backend.get().cache_delete( checkpoint_key )
+		
+		elapsed = max( time.time() - start, 0.001 )
+		logging.info( "BatchUpdate %s: Done, %d pages, %d scores read, %d " \
+			+ "%s in %.1fs, %.1f scores/s.", self.name, pages, read, written,
+			self._verb, elapsed, read / elapsed )
+		
+		return written
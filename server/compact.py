@@ -0,0 +1,106 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Compact binary encoding of top lists, for clients that ask for the
+"compact" format, see RequestAndSubmitHandler.handle_request.
+
+Integers are unsigned LEB128 varints, 7 bits a byte with the high bit set on
+all but the last byte. Signed integers are zigzag encoded first, so small
+negative numbers stay short. A string is the varint length of its UTF-8
+encoding followed by the encoding.
+
+A list is encoded as
+
+	varint number of strings, then the strings: the string table
+	varint string table index of the location of the list
+	varint number of scores n
+	n zigzag varints: the points of the first score, then how much fewer
+		points each following score has than the one before it
+	n zigzag varints: the date of the first score in unix time, then the
+		difference in seconds to the date of the score before it
+	n varints each: the string table index of the names, comments, controls
+		and locations of the scores, in that order
+
+so the values of each key are kept together, and every name, comment,
+control and location is sent only once however many scores share it.
+
+"""
+
+def _write_varint( out, value ):
+	while value > 0x7f:
+		out.append( chr( ( value & 0x7f ) | 0x80 ) )
+		value >>= 7
+	out.append( chr( value ) )
+
+def _write_signed( out, value ):
+	if value < 0:
+		_write_varint( out, ( -value << 1 ) - 1 )
+	else:
+		_write_varint( out, value << 1 )
+
+def encode_varint( value ):
+	out = []
+	_write_varint( out, value )
+	return "".join( out )
+
+def encode_list( location, scores ):
+	"""Return the encoding of a list of score dicts, as in TopList.to_json,
+	sorted by descending points."""
+	strings = []
+	indexes = {}
+	def index( string ):
+		if not string in indexes:
+			indexes[string] = len( strings )
+			strings.append( string )
+		return indexes[string]
+	
+	location_index = index( location )
+	columns = [ [ index( score[key] ) for score in scores ]
+		for key in ( "name", "comment", "control", "location" ) ]
+	
+	out = []
+	_write_varint( out, len( strings ) )
+	for string in strings:
+		if isinstance( string, unicode ):
+			string = string.encode( "utf-8" )
+		_write_varint( out, len( string ) )
+		out.append( string )
+	_write_varint( out, location_index )
+	_write_varint( out, len( scores ) )
+	
+	previous = None
+	for score in scores:
+		points = score["points"]
+		_write_signed( out, points if previous is None \
+			else previous - points )
+		previous = points
+	previous = None
+	for score in scores:
+		date = int( round( score["date"] ) )
+		_write_signed( out, date if previous is None else date - previous )
+		previous = date
+	
+	for column in columns:
+		for i in column:
+			_write_varint( out, i )
+	
+	return "".join( out )
@@ -24,17 +24,122 @@ SECRET_SUBMIT_CODE = "<SECRET SUBMIT CODE HERE>"
 
 SCORE_NAME_MAX_LENGTH = 20
 SCORE_COMMENT_MAX_LENGTH = 50
+# Longer android ids are ignored, the player is then told apart by name.
+PLAYER_ID_MAX_LENGTH = 64
 
 TOP_LIST_LENGTH = 50
 
+# Length of the top lists of the game modes that don't use TOP_LIST_LENGTH.
+GAME_MODE_LIST_LENGTHS = {}
+
+# Scores are kept, and can be paged through, down to this rank of every
+# location and the world. Pages that go further than TOP_LIST_LENGTH are read
+# from the store, starting from the nearest of the cursors the page index of
+# the list keeps every PAGE_INDEX_STEP ranks. Page indexes are cached for
+# PAGE_INDEX_CACHE_TIME seconds, so the ranks of deep pages can lag behind
+# submits by that long. A page has at most PAGE_LIMIT scores.
+LEADERBOARD_LENGTH = 1000
+PAGE_INDEX_STEP = 50
+PAGE_INDEX_CACHE_TIME = 60
+PAGE_LIMIT = 100
+# Submits skip scores below the LEADERBOARD_LENGTH:th of their location, whose
+# points are cached for this many seconds. They can only have gone up since.
+LEADERBOARD_POINTS_CACHE_TIME = 60
+
+# Scores are spread over this many entity groups per control, since each group
+# takes about one write per second. Stored scores are looked up by it, so it
+# can't be changed once there are scores.
+SCORE_SHARD_COUNT = 16
+
+# Also read the single entity group used before sharding, including a
+# duplicate check query on every submit. Turn off once
+# cronjob?migrate_scores=yes reports that nothing is left to move.
+READ_LEGACY_SCORES = True
+
+# A cached top list that needs rebuilding is rebuilt by one request at a time,
+# holding a lease for at most this many seconds. Other requests keep getting
+# the previous version of the list meanwhile. If there is none they wait,
+# checking for the list and trying to take over the lease every
+# LIST_LEASE_WAIT seconds, for up to LIST_LEASE_TIME seconds.
+LIST_LEASE_TIME = 10
+LIST_LEASE_WAIT = 1.0
+
+# Each instance keeps up to LOCAL_LIST_CACHE_SIZE top lists in memory for
+# LOCAL_LIST_CACHE_TTL seconds before checking memcache again. Changes made
+# through other instances can take that long to show up.
+LOCAL_LIST_CACHE_SIZE = 500
+LOCAL_LIST_CACHE_TTL = 5
+
+# Rank histograms are cached for this many seconds, so ranks below the top
+# lists can lag behind submits by that long.
+RANK_HISTOGRAM_CACHE_TIME = 60
+# Each rank histogram is split into this many shards, each its own entity
+# group apart from the scores, so that counting submits doesn't contend with
+# storing scores or with other counts.
+RANK_HISTOGRAM_SHARDS = 20
+# Skipped scores aren't stored, so a marker of each counted one is kept in
+# memcache for this many seconds to not count it again when it is resent.
+RANK_HISTOGRAM_COUNTED_TIME = 24 * 60 * 60
+
+# Each instance keeps the saved countries in memory, checking at most this often
+# whether another instance has saved a new one.
+COUNTRY_REGISTRY_CHECK_TIME = 60
+
+# How many times to retry a compare-and-set of a cached value before giving up.
+CACHE_CAS_RETRIES = 3
+
+# Maintenance batch updates work in pages of this many scores, at most 500
+# since that is the most the datastore puts at once. An interrupted update
+# resumes where it stopped if it is run again within BATCH_CHECKPOINT_TIME
+# seconds.
+BATCH_PAGE_SIZE = 100
+BATCH_CHECKPOINT_TIME = 60 * 60 * 24
+
+# Push queue, see queue.yaml, that runs the per country and control work units
+# the maintenance cron jobs fan out to.
+MAINTENANCE_QUEUE = "maintenance"
+
 # One week in seconds.
 WEEK_LIST_TIME = 60 * 60 * 24 * 7
 
+# Newest /ras protocol version. Version 2 sends the top lists as json objects
+# instead of json strings holding them, version 3 leaves out the lists the
+# client says it has already.
+PROTOCOL_VERSION = 3
+RAW_LISTS_VERSION = 2
+TAGGED_LISTS_VERSION = 3
+
+# Top list formats a request can ask for with "format", from
+# RAW_LISTS_VERSION on. Responses in the compact format, see compact.py, start
+# with COMPACT_RESPONSE_MAGIC, which json can't start with.
+LIST_FORMAT_JSON = "json"
+LIST_FORMAT_COMPACT = "compact"
+COMPACT_RESPONSE_MAGIC = "PRC1"
+
+# Responses to GET /ras reads are cached, and may be cached by browsers and
+# proxies, for this many seconds.
+READ_RESPONSE_CACHE_TIME = 10
+
+# App Engine gzips responses for clients that accept it and drops any
+# Content-Encoding set by the application, so /ras only gzips its responses
+# itself when this is set, which local_server.py does.
+GZIP_RESPONSES = False
+
 VALID_TYPES = ( "all", "non_national", "national" )
 VALID_CONTROLS = ( "tilt", "touch" )
 VALID_GAME_MODES = ( "classic", )
+# Scores submitted without a game mode are of this one. Its boards are named
+# and stored like before there were game modes, see Score.board_name.
+DEFAULT_GAME_MODE = "classic"
+# The boards of these game modes keep only the best score of each player,
+# see Score.keeps_personal_bests. Only list game modes that have no stored
+# scores yet, scores stored before are not merged.
+PERSONAL_BEST_GAME_MODES = ()
 
 NOT_AVAILABLE_LOCATION = "n/a"
 
 LOCATION_WORLD = "location_world"
 LOCATION_WEEK = "location_week"
+# The best scores from everywhere but the country of the request, see
+# Score.get_non_national_list.
+LOCATION_NON_NATIONAL = "location_non_national"
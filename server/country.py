@@ -20,53 +20,97 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import datetime
-from google.appengine.api import memcache
-from google.appengine.ext import db
+import bisect
 import random
+import threading
 import time
 
+import backend
 import config
 
-class Country( db.Model ):
-	location = db.StringProperty( required=True, multiline=False )
+class Country( object ):
+	"""The saved countries, kept sorted in memory by every instance.
+	
+	An instance loads them from the store once, then only checks a
+	generation counter in the cache, at most every
+	config.COUNTRY_REGISTRY_CHECK_TIME seconds, which saving a new country
+	increments. Countries this instance saves are added in place.
+	
+	"""
+	
+	_GENERATION_KEY = "countries:generation"
+	
+	_lock = threading.Lock()
+	_countries = None
+	# location -> index in _countries
+	_indexes = {}
+	_generation = None
+	_checked = 0
 	
 	@classmethod
-	def save( cls, location ):
-		memcache_str = "location:%s" % location
+	def _current_generation( cls ):
+		# Counters made by incr can come back as strings.
+		return int( backend.get().cache_get( cls._GENERATION_KEY ) or 0 )
+	
+	@classmethod
+	def _load( cls ):
+		"""Load the countries if they aren't loaded or another instance has
+		saved one since, checking that at most every
+		config.COUNTRY_REGISTRY_CHECK_TIME seconds. Return them."""
+		now = time.time()
+		if cls._countries is not None \
+				and now - cls._checked < config.COUNTRY_REGISTRY_CHECK_TIME:
+			return cls._countries
 		
-		if memcache.get( memcache_str ) is not None:
+		generation = cls._current_generation()
+		with cls._lock:
+			cls._checked = now
+			if cls._countries is None or generation != cls._generation:
+				countries = sorted( backend.get().all_countries() )
+				cls._indexes = dict( ( location, i )
+					for i, location in enumerate( countries ) )
+				cls._countries = countries
+				cls._generation = generation
+		return cls._countries
+	
+	@classmethod
+	def save( cls, location ):
+		cls._load()
+		if location in cls._indexes:
 			return
 		
-		Country.get_or_insert( location, location=location )
-		memcache.add( memcache_str, 1 )
+		backend.get().save_country( location )
+		generation = backend.get().cache_incr( cls._GENERATION_KEY,
+			initial_value=0 )
+		
+		countries = cls._load()
+		with cls._lock:
+			if location in cls._indexes:
+				return
+			i = bisect.bisect_left( countries, location )
+			countries.insert( i, location )
+			for j in range( i, len( countries ) ):
+				cls._indexes[countries[j]] = j
+			# Only skip reloading for the next check if nobody else saved a
+			# country in between.
+			if generation is not None \
+					and int( generation ) == cls._generation + 1:
+				cls._generation = int( generation )
+	
+	@classmethod
+	def all( cls ):
+		"""Return a sorted list of all saved locations."""
+		return list( cls._load() )
+	
+	@classmethod
+	def is_saved( cls, location ):
+		cls._load()
+		return location in cls._indexes
 	
 	@classmethod
 	def get_random_location( cls ):
-		countries = Country.all().fetch( 1000 )
-		l = len( countries )
-		
-		if l > 0:
-			i = random.randint( 0, l - 1 )
-			country = countries[i]
-			return country.location
+		countries = cls._load()
+		if len( countries ) > 0:
+			return random.choice( countries )
 		else:
 			return None
-	
-	@classmethod
-	def next_country( cls ):
-		fetched = Country.all().order( "location" ).fetch( 1000 )
-		count = len( fetched )
-		
-		# Start from the 0th country if no index is saved.
-		memcache.add( "country_index_next", 0 )
-		
-		index = memcache.get( "country_index_next" )
-		if index >= count:
-			index = 0
-		
-		location = fetched[index].location
-		
-		memcache.set( "country_index_next", index + 1 )
-		
-		return location
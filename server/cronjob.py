@@ -20,171 +20,315 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from google.appengine.api import memcache
-from google.appengine.ext import db
-from google.appengine.ext import webapp
-from google.appengine.ext.webapp.util import run_wsgi_app
-from google.appengine.runtime import DeadlineExceededError
+import datetime
 import logging
+import webapp2
 
+import backend
+from backend import DeadlineExceededError
+from batch import BatchUpdate
 import config
 from country import Country
 from score import Score
+from toplist import WindowTopList
 
-class CronJob(webapp.RequestHandler):
-	def clean_country( self, control, location, lowest_score ):
-		scores = Score.all() \
-			.filter( "control =", control ) \
-			.filter( "location =", location ) \
-			.filter( "points <", lowest_score ) \
-			.filter( "new_week =", False ) \
-			.fetch( 400 )
-		
-		high = 0
-		for s in scores:
-			if s.points > high:
-				high = s.points
-		
-		try:
-			db.delete( scores )
-		except Exception, msg:
-			logging.error( "Got exception: '%s'. Some or all deletes might " \
-				+ "have failed.", msg )
+class CronJob(webapp2.RequestHandler):
+	def _stored_size( self, score ):
+		"""Return roughly how many bytes of property data score takes up
+		in the store, leaving out the key and the index rows."""
+		strings = ( score.name, score.comment, score.board, score.location )
+		# Points and date are 8 bytes each, new_week 1.
+		return sum( len( string.encode( "utf-8" ) ) for string in strings ) \
+			+ 17
+	
+	def prune( self, board, location ):
+		"""Delete every score of board and location that can't show up on
+		any list. Return a tuple ( number of scores deleted, bytes of score
+		data reclaimed ).
+		
+		That is the scores below the first config.LEADERBOARD_LENGTH of the
+		location, which also covers the world since a score on a page of it is
+		on a page of its location too, unless they may still make it onto the
+		week list. The location's scores are read from the store, so the
+		threshold can only be too low, if the query misses the newest scores.
+		
+		Boards that keep personal bests are left alone, they have a score
+		per player, which the ranks count.
+		
+		"""
+		if Score.keeps_personal_bests( board ):
+			return 0, 0
+		
+		started = datetime.datetime.now()
+		threshold = backend.get().nth_points( board, location,
+			config.LEADERBOARD_LENGTH )
+		if threshold is None:
+			return 0, 0
+		
+		# Scores of the last week that may still make it onto the week list,
+		# see WindowTopList. If the cached list is from before there were
+		# WindowTopLists, keep all of the week.
+		week_start = started \
+			- datetime.timedelta( seconds=config.WEEK_LIST_TIME )
+		week_list = Score.get_top_list( Score.list_length( board ), board,
+			config.LOCATION_WEEK )
+		week_candidates = None
+		if isinstance( week_list, WindowTopList ):
+			week_candidates = set( ( d["name"], d["comment"], d["points"],
+				d["location"] ) for d in week_list.candidates )
+		
+		reclaimed = [ 0 ]
+		def pick_invisible( scores ):
+			invisible = []
+			for score in scores:
+				# Submitted after the lists were read.
+				if score.date >= started:
+					continue
+				if score.date > week_start and ( week_candidates is None \
+						or ( score.name, score.comment, score.points,
+						score.location ) in week_candidates ):
+					continue
+				invisible.append( score )
+				reclaimed[0] += self._stored_size( score )
+			return invisible
+		
+		deleted = BatchUpdate( "prune:%s:%s" % ( board, location ), {
+			"board": board,
+			"location": location,
+			"points_below": threshold,
+			"order": "-points",
+		}, pick_invisible, delete=True ).run()
+		
+		logging.info( "CronJob.prune: Deleted %d scores below %d points " \
+			+ "from %s:%s, about %d bytes.", deleted, threshold, board,
+			location, reclaimed[0] )
+		self.response.out.write( "<br />pruned %d scores, about %d bytes, " \
+			% ( deleted, reclaimed[0] ) + "from %s:%s." % ( board,
+			location ) )
+		
+		# Add up what the tasks of a sweep reclaim, see report_pruned.
+		backend.get().cache_incr( "pruned:scores", deleted, initial_value=0 )
+		backend.get().cache_incr( "pruned:bytes", reclaimed[0],
+			initial_value=0 )
+		
+		return deleted, reclaimed[0]
+	
+	def report_pruned( self ):
+		"""Log and reset what prune tasks reclaimed since the last report."""
+		totals = backend.get().cache_get_multi( [ "pruned:scores",
+			"pruned:bytes" ] )
+		backend.get().cache_delete_multi( totals.keys() )
+		
+		scores = int( totals.get( "pruned:scores", 0 ) )
+		reclaimed = int( totals.get( "pruned:bytes", 0 ) )
+		logging.info( "CronJob.report_pruned: The previous sweep deleted %d " \
+			+ "scores, about %d bytes.", scores, reclaimed )
+		self.response.out.write( "<br />previous sweep pruned %d scores, " \
+			% scores + "about %d bytes." % reclaimed )
+	
+	def fan_out( self, unit ):
+		"""Queue a task running unit for every saved country and board."""
+		params = [ {
+			"unit": unit,
+			"board": board,
+			"location": location,
+		} for location in Country.all()
+			for board in Score.boards() ]
+		backend.get().enqueue_tasks( "/cronjob", params )
+		
+		logging.info( "CronJob.fan_out: Queued %d %s tasks.", len( params ),
+			unit )
+		self.response.out.write( "<br />queued %d %s tasks." % (
+			len( params ), unit ) )
+	
+	def run_unit( self, unit, board, location ):
+		"""Run one work unit queued by fan_out."""
+		if unit == "clean_invisible":
+			self.prune( board, location )
+		elif unit == "clear_duplicates":
+			self.delete_duplicates( board, location )
+		else:
+			logging.error( "CronJob.run_unit: Unknown unit \"%s\".", unit )
 	
 	def get(self):
 		self.response.out.write( "cronjob here!<br /><br />" )
 		
+		# A task queued by fan_out.
+		unit = unicode( self.request.get( "unit" ) )
+		if unit != "":
+			board = unicode( self.request.get( "board" ) )
+			location = unicode( self.request.get( "location" ) )
+			if not board in Score.boards() or location == "":
+				logging.error( "CronJob.get: Bad %s task for \"%s\" " \
+					+ "\"%s\".", unit, board, location )
+				return
+			self.run_unit( unit, board, location )
+			return
+		
 		clean_invisible = unicode( self.request.get( "clean_invisible" ) )
 		if clean_invisible == "yes":
-			# Get a location.
-			location = Country.get_random_location()
-			# Get the locations lowest high score.
-			for control in config.VALID_CONTROLS:
-				lowest_score = Score.get_lowest_score( control, location )
-				if lowest_score is None:
-					continue
-				self.clean_country( control, location, lowest_score )
+			self.report_pruned()
+			self.fan_out( "clean_invisible" )
+		
+		migrate_scores = unicode( self.request.get( "migrate_scores" ) )
+		if migrate_scores == "yes":
+			count = 0
+			try:
+				while True:
+					moved = backend.get().migrate_scores( 100 )
+					if moved == 0:
+						break
+					count += moved
+				self.response.out.write( "<br />moved %d scores, done." \
+					% count )
+			except DeadlineExceededError, ex:
+				logging.error( "CronJob.get: Got DeadlineExceededError. " \
+					+ "Managed to move %d scores.", count )
+				return
 		
 		flush = unicode( self.request.get( "flush" ) )
 		if flush == "yes":
-			memcache.flush_all()
+			backend.get().cache_flush()
+			Score._local_lists.clear()
 		
 		reflag_week_shallow = unicode( self.request.get(
 			"reflag_week_shallow" ) )
 		if reflag_week_shallow == "yes":
-			Score.reflag_new_week()
-			
-			Score._delete_cached_list( "tilt", config.LOCATION_WEEK )
-			Score._delete_cached_list( "touch", config.LOCATION_WEEK )
+			try:
+				changed = Score.reflag_new_week()
+				self.response.out.write( "<br />reflagged %d scores, done." \
+					% changed )
+			except DeadlineExceededError, ex:
+				logging.error( "CronJob.get: Got DeadlineExceededError while " \
+					+ "reflagging, the next run resumes it." )
+				return
+		
+		seed_rank_histograms = unicode( self.request.get(
+			"seed_rank_histograms" ) )
+		if seed_rank_histograms == "yes":
+			try:
+				count = Score.seed_histograms()
+			except DeadlineExceededError, ex:
+				logging.error( "CronJob.get: Got DeadlineExceededError while " \
+					+ "seeding the rank histograms, the next run resumes it." )
+				return
+			self.response.out.write( "<br />counted %d scores in the rank " \
+				% count + "histograms, done." )
+		
+		set_score_days = unicode( self.request.get( "set_score_days" ) )
+		if set_score_days == "yes":
+			# Put the scores of the week again so that the ones stored before
+			# scores had a day get one, see Backend.recent_top_scores. Older
+			# scores are never on the week list.
+			week_start = datetime.datetime.now() \
+				- datetime.timedelta( seconds=config.WEEK_LIST_TIME )
+			try:
+				count = BatchUpdate( "score_days", {
+					"date_after": week_start,
+					"order": "-date",
+				}, lambda scores: scores ).run()
+			except DeadlineExceededError, ex:
+				logging.error( "CronJob.get: Got DeadlineExceededError while " \
+					+ "setting score days, the next run resumes it." )
+				return
+			self.response.out.write( "<br />set the day of %d scores, " \
+				% count + "done." )
 			
-			for control in ("tilt", "touch"):
-				Score.get_top_list(config.TOP_LIST_LENGTH, control,
-					config.LOCATION_WEEK)
+			for board in Score.boards():
+				Score._invalidate_cached_list( board, config.LOCATION_WEEK )
 		
 		clear_world_week_duplicates = unicode( self.request.get(
 			"clear_world_week_duplicates" ) )
 		if clear_world_week_duplicates == "yes":
-			for location in ( config.LOCATION_WORLD, config.LOCATION_WEEK ):
-				for control in config.VALID_CONTROLS:
-					self.delete_duplicates( control, location )
+			# The week's scores are among the world's.
+			for board in Score.boards():
+				self.delete_duplicates( board, config.LOCATION_WORLD )
 		
 		clear_random_country_duplicates = unicode( self.request.get(
 			"clear_random_country_duplicates" ) )
 		if clear_random_country_duplicates == "yes":
 			location = Country.get_random_location()
-			for control in config.VALID_CONTROLS:
-				self.delete_duplicates( control, location )
+			for board in Score.boards():
+				self.delete_duplicates( board, location )
 		
 		clear_country_duplicates = unicode( self.request.get(
 			"clear_country_duplicates" ) )
 		if clear_country_duplicates != "":
-			for control in config.VALID_CONTROLS:
-				self.delete_duplicates( control, clear_country_duplicates )
+			for board in Score.boards():
+				self.delete_duplicates( board, clear_country_duplicates )
 		
 		clear_all_country_duplicates = unicode( self.request.get(
 			"clear_all_country_duplicates" ) )
 		if clear_all_country_duplicates == "yes":
-			start_location = Country.next_country()
-			location = start_location
-			count = 0
-			try:
-				while True:
-					for control in config.VALID_CONTROLS:
-						self.delete_duplicates( control, location )
-					location = Country.next_country()
-					count += 1
-			except DeadlineExceededError, ex:
-				logging.error( "CronJob.get: Got DeadlineExceededError. " \
-					+ "Managed to clear %d countries from \"%s\" to \"%s\"",
-					count, start_location, location )
-				return
+			self.fan_out( "clear_duplicates" )
 	
-	def delete_duplicates( self, control, location ):
-		scores = Score.all().filter( "control =", control )
+	def post( self ):
+		# Tasks are POSTed.
+		self.get()
+	
+	def delete_duplicates( self, board, location ):
+		"""Delete all but the oldest copy of every score of board and
+		location, or of every location for config.LOCATION_WORLD. Walks all
+		the stored scores once, see BatchUpdate.
 		
-		if not location in ( config.LOCATION_WORLD, config.LOCATION_WEEK ):
-			scores = scores.filter( "location =", location )
+		Copies have the same points, so walking the scores by points only
+		the scores with the current points have to be remembered.
 		
-		elif location == config.LOCATION_WEEK:
-			scores = scores.filter( "new_week =", True )
-		elif location != config.LOCATION_WORLD:
-			logging.error( "CronJob.delete_duplicates: Got an invalid " \
-				+ "location \"%s\".", location )
-			return
+		"""
+		query = {
+			"board": board,
+			"order": "-points",
+		}
+		if location != config.LOCATION_WORLD:
+			query["location"] = location
+		
+		# fingerprint -> oldest score with it so far, of the current points
+		oldest = {}
+		current_points = [ None ]
+		deleted_locations = set()
+		def pick_copies( scores ):
+			copies = []
+			for score in scores:
+				if score.points != current_points[0]:
+					oldest.clear()
+					current_points[0] = score.points
+				
+				fingerprint = ( score.name, score.comment, score.points,
+					score.board, score.location )
+				kept = oldest.get( fingerprint )
+				if kept is None:
+					oldest[fingerprint] = score
+					continue
+				
+				if score.date < kept.date:
+					oldest[fingerprint] = score
+					score, kept = kept, score
+				copies.append( score )
+				deleted_locations.add( score.location )
+			return copies
+		
+		deleted = BatchUpdate( "duplicates:%s:%s" % ( board, location ),
+			query, pick_copies, delete=True ).run()
+		
+		logging.info( "CronJob.delete_duplicates: Deleted %d copies from " \
+			+ "%s:%s.", deleted, board, location )
+		self.response.out.write( "<br />deleted %d copies from %s:%s." % (
+			deleted, board, location ) )
 		
-		fetched = scores.order( "-points" ).fetch( config.TOP_LIST_LENGTH )
-		fetched = sorted( fetched, key=lambda score: score.date )
-		
-		to_remove = []
-		i = 0
-		while i < len( fetched ):
-			scorei = fetched[i]
-			j = i+1
-			while j < len( fetched ):
-				scorej = fetched[j]
-				if not scorei is scorej and scorei.equals( scorej ) \
-						and not scorej in to_remove:
-					to_remove.append( scorej )
-				j += 1
-			i += 1
-		
-		have = [ score.to_dict() for score in fetched ]
-		logging.info( "Location: \"%s\" Have %d scores: %s", location,
-			len( have ), have )
-		
-		would = [ score.to_dict() for score in to_remove ]
-		logging.info( "Location: \"%s\"Would remove %d scores: %s", location,
-			len( would ), would )
-		
-		count1 = 0
-		for score in to_remove:
-			if score in fetched:
-				count1 += 1
-		
-		count2 = 0
-		for score in fetched:
-			if score in to_remove:
-				count2 += 1
-		
-		logging.info( "count1: %d, count2: %d", count1, count2 )
-		
-		try:
-			db.delete( to_remove )
-			self.response.out.write(
-				"<br />all entities deleted successfully." )
-		except Exception, msg:
-			self.response.out.write( "<br />Got exception: '%s'." % msg \
-				+ "<br />Some or all deletes might have failed." )
-		
-		if len(to_remove) > 0:
-			# Clear the old lists.
-			Score._delete_cached_list( control, location )
-			# Request new lists so that they're cached.
-			Score.get_top_list( config.TOP_LIST_LENGTH, control, location )
+		if deleted > 0:
+			# Invalidate the lists the copies may have been on and request
+			# new ones so that they're cached.
+			locations = sorted( deleted_locations ) + [ config.LOCATION_WORLD,
+				config.LOCATION_WEEK ]
+			for list_location in locations:
+				Score._invalidate_cached_list( board, list_location )
+			Score.get_top_lists( Score.list_length( board ), board,
+				locations )
 
-application = webapp.WSGIApplication( [ ( "/cronjob", CronJob ) ] )
+application = webapp2.WSGIApplication( [ ( "/cronjob", CronJob ) ] )
 
 def main():
+	from google.appengine.ext.webapp.util import run_wsgi_app
 	run_wsgi_app( application )
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import zlib
+
+class PointsHistogram( object ):
+	"""Number of scores by points, for ranking scores beyond the top lists.
+	
+	Points are counted in buckets that are exact below 2**SUB_BUCKET_BITS
+	points and split every power of two into 2**(SUB_BUCKET_BITS - 1) equal
+	buckets above that, so a bucket is at most about 3% of its points wide.
+	The buckets are kept as a Fenwick tree, which makes both adding a score
+	and counting the scores above some points O(log BUCKET_COUNT).
+	
+	Fenwick trees add up element wise, so histograms of shards can be merged
+	with merge.
+	
+	"""
+	
+	SUB_BUCKET_BITS = 6
+	# Points are capped to this, which only makes the top bucket wider.
+	MAX_POINTS = 2 ** 40 - 1
+	
+	@classmethod
+	def bucket( cls, points ):
+		points = min( max( points, 0 ), cls.MAX_POINTS )
+		if points < 1 << cls.SUB_BUCKET_BITS:
+			return points
+		exponent = points.bit_length() - cls.SUB_BUCKET_BITS
+		return ( exponent << ( cls.SUB_BUCKET_BITS - 1 ) ) \
+			+ ( points >> exponent )
+	
+	@classmethod
+	def bucket_range( cls, bucket ):
+		"""Return the lowest and highest points of bucket."""
+		if bucket < 1 << cls.SUB_BUCKET_BITS:
+			return bucket, bucket
+		exponent = ( bucket >> ( cls.SUB_BUCKET_BITS - 1 ) ) - 1
+		mantissa = bucket - ( exponent << ( cls.SUB_BUCKET_BITS - 1 ) )
+		return mantissa << exponent, ( ( mantissa + 1 ) << exponent ) - 1
+	
+	def __init__( self, tree=None ):
+		if tree is None:
+			tree = [ 0 ] * BUCKET_COUNT
+		self._tree = tree
+	
+	def add( self, points, count=1 ):
+		i = self.bucket( points ) + 1
+		while i <= BUCKET_COUNT:
+			self._tree[i - 1] += count
+			i += i & -i
+	
+	def _count_to( self, bucket ):
+		"""Return the number of scores in buckets up to and including
+		bucket."""
+		count = 0
+		i = bucket + 1
+		while i > 0:
+			count += self._tree[i - 1]
+			i -= i & -i
+		return count
+	
+	@property
+	def total( self ):
+		return self._count_to( BUCKET_COUNT - 1 )
+	
+	def count_above( self, points ):
+		"""Return the estimated number of scores with more points than
+		points, assuming the scores of a bucket are spread evenly over it."""
+		bucket = self.bucket( points )
+		up_to = self._count_to( bucket )
+		above = self.total - up_to
+		
+		in_bucket = up_to - self._count_to( bucket - 1 )
+		low, high = self.bucket_range( bucket )
+		points = min( max( points, 0 ), self.MAX_POINTS )
+		above += in_bucket * float( high - points ) / ( high - low + 1 )
+		
+		return int( round( above ) )
+	
+	def merge( self, other ):
+		for i, count in enumerate( other._tree ):
+			self._tree[i] += count
+	
+	def dumps( self ):
+		return zlib.compress( json.dumps( self._tree ) )
+	
+	@classmethod
+	def loads( cls, data ):
+		return cls( json.loads( zlib.decompress( data ) ) )
+
+BUCKET_COUNT = PointsHistogram.bucket( PointsHistogram.MAX_POINTS ) + 1
@@ -0,0 +1,90 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Serve /ras and /cronjob from one process with the SQLite backend.
+
+Meant for load testing and profiling outside of App Engine:
+
+	python local_server.py --port 8080 --database scores.sqlite
+
+Requests without an X-AppEngine-country header get the --country one.
+
+"""
+
+import argparse
+import logging
+from wsgiref.simple_server import make_server
+
+import backend
+import config
+from backend_local import LocalBackend
+
+def dispatcher( applications, country ):
+	"""Return a WSGI application routing on path to applications, a dict of
+	path to WSGI application."""
+	
+	def application( environ, start_response ):
+		environ.setdefault( "HTTP_X_APPENGINE_COUNTRY", country )
+		app = applications.get( environ.get( "PATH_INFO", "" ) )
+		if app is None:
+			start_response( "404 Not Found",
+				[ ( "Content-Type", "text/plain" ) ] )
+			return [ "not found" ]
+		return app( environ, start_response )
+	
+	return application
+
+def main():
+	parser = argparse.ArgumentParser( description=__doc__.split( "\n" )[0] )
+	parser.add_argument( "--host", default="127.0.0.1" )
+	parser.add_argument( "--port", type=int, default=8080 )
+	parser.add_argument( "--database", default=":memory:",
+		help="SQLite database file, in memory by default" )
+	parser.add_argument( "--country", default="se",
+		help="Country used for requests without a country header" )
+	parser.add_argument( "--workers", type=int, default=4,
+		help="Number of threads running queued tasks" )
+	args = parser.parse_args()
+	
+	logging.basicConfig( level=logging.INFO )
+	local_backend = LocalBackend( args.database, args.workers )
+	backend.use( local_backend )
+	# There is no front end compressing the responses.
+	config.GZIP_RESPONSES = True
+	
+	# Import the handlers after the backend is installed.
+	import cronjob
+	import ras
+	
+	application = dispatcher( {
+		"/ras": ras.application,
+		"/cronjob": cronjob.application,
+	}, args.country )
+	# Queued tasks, like the cron job work units, run in this process too.
+	local_backend.task_queue.application = application
+	
+	server = make_server( args.host, args.port, application )
+	logging.info( "Serving on http://%s:%d", args.host, args.port )
+	server.serve_forever()
+
+if __name__ == "__main__":
+	main()
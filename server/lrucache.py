@@ -0,0 +1,63 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import threading
+import time
+
+class LRUCache( object ):
+	"""Size bounded, thread safe, least recently used cache of values that
+	expire ttl seconds after they were set. Unlike memcache it hands out the
+	cached objects themselves, so callers must not change them."""
+	
+	def __init__( self, size, ttl ):
+		self.size = size
+		self.ttl = ttl
+		# key -> ( value, expiry time ), least recently used first.
+		self._entries = collections.OrderedDict()
+		self._lock = threading.Lock()
+	
+	def get( self, key ):
+		with self._lock:
+			entry = self._entries.pop( key, None )
+			if entry is None:
+				return None
+			value, expires = entry
+			if expires <= time.time():
+				return None
+			self._entries[key] = entry
+			return value
+	
+	def set( self, key, value ):
+		with self._lock:
+			self._entries.pop( key, None )
+			self._entries[key] = ( value, time.time() + self.ttl )
+			while len( self._entries ) > self.size:
+				self._entries.popitem( last=False )
+	
+	def delete( self, key ):
+		with self._lock:
+			self._entries.pop( key, None )
+	
+	def clear( self ):
+		with self._lock:
+			self._entries.clear()
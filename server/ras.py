@@ -20,36 +20,204 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from google.appengine.ext.webapp.util import run_wsgi_app
+import StringIO
+import gzip
+import hashlib
 import logging
 import json
 import webapp2
 
+import backend
 import config
+from compact import encode_varint
+from country import Country
 from score import Score
 
+def gzip_string( data ):
+	out = StringIO.StringIO()
+	gzipped = gzip.GzipFile( fileobj=out, mode="wb", compresslevel=6 )
+	gzipped.write( data )
+	gzipped.close()
+	return out.getvalue()
+
 class RequestAndSubmitHandler( webapp2.RequestHandler ):
-	def send_response( self, success, request_response=None ):
-		response = {
-			"request": request_response,
-		}
+	def accepts_gzip( self ):
+		"""Return whether the response should be gzipped here, which is only
+		when config.GZIP_RESPONSES is set and the client accepts it."""
+		return config.GZIP_RESPONSES \
+			and "gzip" in self.request.headers.get( "Accept-Encoding", "" )
+	
+	def write_pieces( self, pieces ):
+		"""Write the strings of pieces as the response body, gzipped if
+		accepts_gzip."""
+		if not self.accepts_gzip():
+			for piece in pieces:
+				self.response.out.write( piece )
+			return
+		
+		self.response.headers["Content-Encoding"] = "gzip"
+		size = 0
+		gzipped = gzip.GzipFile( fileobj=self.response.out, mode="wb",
+			compresslevel=6 )
+		for piece in pieces:
+			gzipped.write( piece )
+			size += len( piece )
+		gzipped.close()
+		
+		logging.info( "RequestAndSubmitHandler.write_pieces: %d bytes, %d " \
+			+ "gzipped.", size, self.response.content_length or 0 )
+	
+	def response_pieces( self, request_response ):
+		"""Generate the pieces of the response body."""
+		if request_response is None or request_response["version"] \
+				< config.RAW_LISTS_VERSION:
+			response = {
+				"request": request_response,
+			}
+			
+			yield json.dumps( response )
+			return
+		
+		if request_response.get( "format" ) == config.LIST_FORMAT_COMPACT:
+			header = dict( ( key, value ) for key, value
+				in request_response.iteritems() if key != "data" )
+			header_json = json.dumps( header )
+			yield config.COMPACT_RESPONSE_MAGIC
+			yield encode_varint( len( header_json ) )
+			yield header_json
+			yield encode_varint( len( request_response["data"] ) )
+			for list_compact in request_response["data"]:
+				if list_compact is None:
+					yield encode_varint( 0 )
+				else:
+					yield encode_varint( len( list_compact ) )
+					yield list_compact
+			return
 		
-		raw_json = json.dumps( response )
+		# The lists are json dumps already, write them out as they are
+		# rather than dumping them as strings.
+		yield "{\"request\": {"
+		for key, value in request_response.iteritems():
+			if key != "data":
+				yield "%s: %s, " % ( json.dumps( key ), json.dumps( value ) )
+		yield "\"data\": ["
+		for i, list_json in enumerate( request_response["data"] ):
+			if i > 0:
+				yield ", "
+			if list_json is None:
+				yield "null"
+			else:
+				yield list_json
+		yield "]}}"
+	
+	def content_type( self, request_response ):
+		"""Return the Content-Type of the response body, or None for the
+		default one."""
+		if request_response is not None and request_response.get(
+				"format" ) == config.LIST_FORMAT_COMPACT:
+			return "application/octet-stream"
+		elif request_response is not None and request_response["version"] \
+				>= config.RAW_LISTS_VERSION:
+			return "application/json"
+		return None
+	
+	def send_response( self, success, request_response=None ):
+		content_type = self.content_type( request_response )
+		if content_type is not None:
+			self.response.headers["Content-Type"] = content_type
+		self.write_pieces( self.response_pieces( request_response ) )
+	
+	def handle_page( self, page_request, board, location ):
+		"""Return the page of a list asked for by the "page" of a request,
+		see handle_request, or None if it is invalid."""
+		try:
+			list_location = {
+				"local": location,
+				"world": config.LOCATION_WORLD,
+				"week": config.LOCATION_WEEK,
+			}[page_request.get( "list", "local" )]
+			limit = min( int( page_request.get( "limit",
+				Score.list_length( board ) ) ), config.PAGE_LIMIT )
+			if "around" in page_request:
+				offset, scores = Score.get_page_around( board,
+					list_location, int( page_request["around"] ), limit )
+			else:
+				offset = int( page_request.get( "offset", 0 ) )
+				scores = Score.get_page( board, list_location, offset,
+					limit )
+		except Exception, e:
+			logging.error( "handle_page: failed to get page %s. " \
+				+ "Exception: %s", repr( page_request ), repr( e ) )
+			return None
 		
-		self.response.out.write( raw_json )
+		return {
+			"location": list_location,
+			"offset": offset,
+			"scores": scores,
+		}
 	
 	def handle_request( self, request, location ):
-		"""Return a json object with keys control and data.
+		"""Return a json object with keys control, version and data, rank
+		if the request has a "rank" with a number of points to rank, and page
+		if it has a "page" of a list to get.
 		
 		Example return value:
 		{
 			"control": "touch",
-			"data": (local_list, world_list, week_list)
+			"version": 2,
+			"data": (local_list, world_list, week_list[, non_national_list]),
+			"rank":
+			{
+				"local": {"rank": <rank>, "percentile": <percentile>},
+				"world": {"rank": <rank>, "percentile": <percentile>}
+			},
+			"page":
+			{
+				"location": <location of the list>,
+				"offset": <number of scores before the page>,
+				"scores": [score_dict1, score_dict2, ...]
+			}
 		}
 		
 		where the data *_list entries are string dumps of json objects
 		containing information about a top list as returned by
-		Score.get_top_list.
+		Score.get_top_list, and non_national_list is only there if the
+		request has "non_national" true, see Score.get_non_national_list.
+		rank and percentile are as returned by Score.get_rank. The page is
+		the Score.get_page of the request's "page" "offset", or the
+		Score.get_page_around of its "around" points, of at most "limit"
+		scores, Score.list_length by default and at most config.PAGE_LIMIT,
+		from the "local", "world" or "week" "list", "local" by default.
+		
+		The request can ask for the lists of one of config.VALID_GAME_MODES
+		with "game_mode", config.DEFAULT_GAME_MODE by default. The lists,
+		ranks and pages are then those of the Score.board_name of the control
+		and game mode, and the response has "game_mode" too unless it is the
+		default one.
+		
+		version is the protocol version of the response, the one of the
+		request clamped to 1 through config.PROTOCOL_VERSION. Requests without
+		one are version 1. From config.RAW_LISTS_VERSION on, send_response
+		writes the lists as json objects instead of strings.
+		
+		From config.TAGGED_LISTS_VERSION on, the response also has "tags",
+		the TopList.etag of each of the lists in the same order as data. The
+		request can send the "tags" of the lists it has, in that order too,
+		and lists with the same tag are left out of data as null.
+		
+		From config.RAW_LISTS_VERSION on, the request can also ask for the
+		config.LIST_FORMAT_COMPACT "format". The response then has "format"
+		too, the data entries are TopList.to_compact encodings, and
+		send_response writes
+		
+			config.COMPACT_RESPONSE_MAGIC
+			varint length of the json dump of the rest of the response
+			the json dump of the rest of the response
+			varint number of lists
+			for each list, the varint length of its encoding and the
+				encoding, or a 0 length for lists left out
+		
+		with varints as in compact.py.
 		
 		"""
 		
@@ -71,18 +239,83 @@ class RequestAndSubmitHandler( webapp2.RequestHandler ):
 			logging.error( "handle_request: got invalid control %s.", control )
 			return
 		
-		# Get the json dump part of the top lists.
-		local_json = Score.get_top_list( config.TOP_LIST_LENGTH, control,
-			location )[0]
-		world_json = Score.get_top_list( config.TOP_LIST_LENGTH, control,
-			config.LOCATION_WORLD )[0]
-		week_json = Score.get_top_list( config.TOP_LIST_LENGTH, control,
-			config.LOCATION_WEEK )[0]
+		game_mode = request.get( "game_mode", config.DEFAULT_GAME_MODE )
+		if not game_mode in config.VALID_GAME_MODES:
+			logging.error( "handle_request: got invalid game mode %s.",
+				repr( game_mode ) )
+			return
+		board = Score.board_name( control, game_mode )
+		
+		try:
+			version = max( 1, min( int( request.get( "version", 1 ) ),
+				config.PROTOCOL_VERSION ) )
+		except Exception, e:
+			logging.error( "handle_request: got invalid version %s.",
+				repr( request.get( "version" ) ) )
+			return
+		
+		# Get the top lists in one go, then the json dump part of them.
+		top_lists = Score.get_top_lists( Score.list_length( board ), board,
+			[ location, config.LOCATION_WORLD, config.LOCATION_WEEK ] )
+		if request.get( "non_national" ) is True:
+			top_lists.append( Score.get_non_national_list( board,
+				location ) )
+		
+		known_tags = []
+		if version >= config.TAGGED_LISTS_VERSION:
+			known_tags = request.get( "tags" )
+			if not isinstance( known_tags, list ):
+				known_tags = []
+		
+		list_format = config.LIST_FORMAT_JSON
+		if version >= config.RAW_LISTS_VERSION:
+			list_format = request.get( "format", config.LIST_FORMAT_JSON )
+			if not list_format in ( config.LIST_FORMAT_JSON,
+					config.LIST_FORMAT_COMPACT ):
+				logging.warning( "handle_request: got invalid format %s, " \
+					+ "sending json.", repr( list_format ) )
+				list_format = config.LIST_FORMAT_JSON
+		
+		data = []
+		for i, top_list in enumerate( top_lists ):
+			if i < len( known_tags ) and known_tags[i] == top_list.etag():
+				data.append( None )
+			elif list_format == config.LIST_FORMAT_COMPACT:
+				data.append( top_list.to_compact() )
+			else:
+				data.append( top_list.to_json() )
 		
 		to_return = {
 			"control": control,		# "tilt" / "touch"
-			"data": ( local_json, world_json, week_json ),
+			"version": version,
+			"data": tuple( data ),
 		}
+		if version >= config.TAGGED_LISTS_VERSION:
+			to_return["tags"] = [ top_list.etag() for top_list in top_lists ]
+		if list_format == config.LIST_FORMAT_COMPACT:
+			to_return["format"] = list_format
+		if game_mode != config.DEFAULT_GAME_MODE:
+			to_return["game_mode"] = game_mode
+		
+		if "rank" in request:
+			try:
+				points = int( request["rank"] )
+				ranks = Score.get_ranks( points, board,
+					[ location, config.LOCATION_WORLD ] )
+			except Exception, e:
+				logging.error( "handle_request: failed to rank %s. " \
+					+ "Exception: %s", repr( request["rank"] ), repr( e ) )
+			else:
+				to_return["rank"] = dict( ( name, {
+					"rank": rank,
+					"percentile": percentile,
+				} ) for name, ( rank, percentile ) in zip(
+					( "local", "world" ), ranks ) )
+		
+		if "page" in request and isinstance( request["page"], dict ):
+			page = self.handle_page( request["page"], board, location )
+			if page is not None:
+				to_return["page"] = page
 		
 		return to_return
 	
@@ -111,77 +344,24 @@ class RequestAndSubmitHandler( webapp2.RequestHandler ):
 		if len( scores ) == 0:
 			return True
 		
-		# As the list of scores are submitted, their respective points are
-		# checkd whether they would show up on a list. If they would not, and
-		# since the list is sorted descending, we know any subsequent score
-		# with the same control type wont show up either.
-		# Therefore we want to remember if a score of a specific control would
-		# not show up. If it would not, subsequent scores with the same control
-		# type will be skipped and not submitted. For this purpose, create
-		# dictionary { "touch": True, "tilt": True } for config.VALID_CONTROLS =
-		# ( "touch", "tilt" ). Control types to initially submit are marked
-		# when sorting.
-		stop_submit = dict( ( cont, True ) for cont in config.VALID_CONTROLS )
-		
-		def sort_func(score):
-			# Mark this control as used.
-			c = score["control"]
-			stop_submit[c] = False
-			# Do the actual sorting.
-			return -score["points"]
-		
-		# Sort descending by points.
-		scores = sorted( scores, key=sort_func )
-		
-		submit_count = 0
-		
+		# Leave out scores that are missing values and submit the rest in one
+		# go. Score.submit_many filters out the ones that wouldn't show up on
+		# any list before touching the store.
+		to_submit = []
 		for score in scores:
-			try:
-				score_control = score["control"]
-			except KeyError, ex:
-				logging.warning( "handle_submit: Got KeyError when getting " \
-					+ "score control." )
-				continue
-			
-			if stop_submit[score_control]:
-				logging.info( "handle_submit: Stop submit True for %s, " \
-					+ "continuing.", score_control)
-				continue
-			
-			try:
-				score_points = score["points"]
-			except KeyError, ex:
-				logging.warning( "handle_submit: Got KeyError when getting " \
-					+ "score points." )
-				continue
-			
-			if not Score._would_show_on_location_or_week_lists( location,
-					score_points, score_control ):
-				# Since the scores list is sorted descending by points, no
-				# score of this control will be postable from now on.
-				stop_submit[score_control] = True
-				logging.info( "handle_submit: Setting stop submit for %s, " \
-					+ "continuing.", score_control)
-				# If there are no control types left to check, stop the loop.
-				if not ( False in stop_submit.values() ):
-					logging.info( "handle_submit: Found no False in " \
-						+ "stop_submit, breaking." )
-					break
+			missing = [ key for key in ( "name", "comment", "points",
+				"control" ) if not key in score ]
+			if len( missing ) > 0:
+				logging.warning( "handle_submit: Score is missing %s. " \
+					+ "Dictionary: %s", ", ".join( missing ), str( score ) )
 				continue
-			
-			try:
-				name = score["name"]
-				comment = score["comment"]
-			except KeyError, ex:
-				logging.warning( "handle_submit: Got KeyError: %s. " \
-					+ "Dictionary: %s", repr( ex ), str( score ) )
-				continue
-			
-			status = Score.submit( name, comment, score_points, score_control,
-				location )
-			
-			submit_count += 1
-			
+			to_submit.append( score )
+		
+		statuses = Score.submit_many( to_submit, location,
+			submit_data.get( "android_id" ) )
+		
+		success = True
+		for score, status in zip( to_submit, statuses ):
 			# If the submit fails because of an error, log as much of it as
 			# possible so we maybe can submit it manually later.
 			if status == Score.SUBMIT_FAIL:
@@ -192,18 +372,101 @@ class RequestAndSubmitHandler( webapp2.RequestHandler ):
 					pass
 				logging.critical( "RequestAndSubmitHandler.handle_submit: " \
 					+ "score submit failed. JSON: %s", json_dump)
-				logging.info( "Submitted %d of %d scores before the error.",
-					submit_count - 1, len( scores ) )
-				
-				return False
+				success = False
 		
 		logging.info( "Out of %d scores, submitted %d.", len( scores ),
-			submit_count )
+			statuses.count( Score.SUBMIT_SUCCESS ) )
 		
-		return True
+		return success
 	
 	def get( self ):
-		self.post()
+		# Older clients send the data of a post with GET.
+		if self.request.get( "data" ):
+			self.post()
+		else:
+			self.read()
+	
+	def read( self ):
+		"""Handle a pure read, which is a GET without data:
+		
+		/ras?control=<control>&version=<version>&format=<format>&country=<c>
+			&game_mode=<game mode>
+		
+		with version, format and game_mode as in the request of a post, see
+		handle_request, and all optional. The response is the one to a post
+		of that request without submit, from the country of the country
+		parameter if that is a saved country, otherwise the one of the
+		client.
+		
+		Since the response only depends on the URL and, without a valid
+		country, the country header, it is rendered once per
+		config.READ_RESPONSE_CACHE_TIME seconds and kept in memcache, and
+		browsers and proxies are told they can cache it for that long too.
+		
+		"""
+		control = self.request.get( "control" )
+		game_mode = self.request.get( "game_mode", config.DEFAULT_GAME_MODE )
+		list_format = self.request.get( "format", config.LIST_FORMAT_JSON )
+		try:
+			# Clamped, since it is part of the cache key.
+			version = max( 1, min( int( self.request.get( "version",
+				"1" ) ), config.PROTOCOL_VERSION ) )
+		except ValueError:
+			version = None
+		if not control in config.VALID_CONTROLS or version is None \
+				or not game_mode in config.VALID_GAME_MODES \
+				or not list_format in ( config.LIST_FORMAT_JSON,
+				config.LIST_FORMAT_COMPACT ):
+			logging.error( "RequestAndSubmitHandler.read: got invalid read " \
+				+ "%s.", self.request.query_string )
+			self.error( 400 )		#Send a 400 Bad Request
+			return
+		
+		vary = [ "Accept-Encoding" ]
+		location = self.request.get( "country" ).lower()
+		if not Country.is_saved( location ):
+			location = self.request.headers["X-AppEngine-country"].lower()
+			vary.append( "X-AppEngine-Country" )
+		
+		cache_key = "response:%s:%s:%d:%s" % ( Score.board_name( control,
+			game_mode ), location, version, list_format )
+		rendered = backend.get().cache_get( cache_key )
+		if not isinstance( rendered, dict ):
+			request_response = self.handle_request( {
+				"control": control,
+				"game_mode": game_mode,
+				"version": version,
+				"format": list_format,
+			}, location )
+			body = "".join( self.response_pieces( request_response ) )
+			rendered = {
+				"content_type": self.content_type( request_response ),
+				"etag": hashlib.md5( body ).hexdigest()[:16],
+				"body": body,
+			}
+			if config.GZIP_RESPONSES:
+				rendered["gzipped"] = gzip_string( body )
+			backend.get().cache_set( cache_key, rendered,
+				time=config.READ_RESPONSE_CACHE_TIME )
+		
+		headers = self.response.headers
+		headers["Cache-Control"] = "public, max-age=%d" \
+			% config.READ_RESPONSE_CACHE_TIME
+		headers["Vary"] = ", ".join( vary )
+		headers["ETag"] = "\"%s\"" % rendered["etag"]
+		if rendered["content_type"] is not None:
+			headers["Content-Type"] = rendered["content_type"]
+		
+		if rendered["etag"] in self.request.headers.get( "If-None-Match",
+				"" ):
+			self.response.status = 304
+			return
+		
+		if self.accepts_gzip() and "gzipped" in rendered:
+			headers["Content-Encoding"] = "gzip"
+			self.response.out.write( rendered["gzipped"] )
+		else:
+			self.response.out.write( rendered["body"] )
 	
 	def post( self ):
 		
@@ -211,17 +474,34 @@ class RequestAndSubmitHandler( webapp2.RequestHandler ):
 		# {
 		#	"request":
 		#	{
-		#		"control": "tilt" / "touch"
+		#		"control": "tilt" / "touch",
+		#		"game_mode": <one of config.VALID_GAME_MODES, optional>,
+		#		"version": <int protocol version, optional, 1 by default>,
+		#		"tags": [<tag of the lists the client has, optional>, ...],
+		#		"format": "json" / "compact", optional, "json" by default
+		#		"rank": <int points, optional>,
+		#		"non_national": <true to also get the list of the best scores
+		#			from other countries, optional>,
+		#		"page":
+		#		{
+		#			"list": "local" / "world" / "week", optional,
+		#			"offset": <int scores to skip, optional>,
+		#			"around": <int points, optional, instead of offset>,
+		#			"limit": <int most scores, optional>
+		#		}
 		#	}
 		#	"submit:
 		#	{
 		#		"code": <submit code>
-		#		"android_id": <android id>
+		#		"android_id": <android id, optional, tells players apart on
+		#			boards that keep personal bests>
 		#		"scores":
 		#		[
 		#			{
 		#				"name": <string value, max chars set in config>,
 		#				"control": "tilt" / "touch",
+		#				"game_mode": <one of config.VALID_GAME_MODES,
+		#					optional>,
 		#				"points": <int points>,
 		#				"comment": <string value, max chars set in config>,
 		#			},
@@ -288,5 +568,9 @@ class RequestAndSubmitHandler( webapp2.RequestHandler ):
 application = webapp2.WSGIApplication( [
 	( "/ras", RequestAndSubmitHandler ) ] )
 
-if __name__ == "__main__":
+def main():
+	from google.appengine.ext.webapp.util import run_wsgi_app
 	run_wsgi_app( application )
+
+if __name__ == "__main__":
+	main()
@@ -21,48 +21,117 @@
 # SOFTWARE.
 
 import datetime
-from google.appengine.api import memcache
-from google.appengine.ext import db
-from google.appengine.ext import ndb
-import json
+import hashlib
 import logging
 import time
 
+import backend
+from batch import BatchUpdate
 import config
-from country import Country
-
-# Singleton scorelist entity type
-class Scorelist( db.Model ):
-	# Use the single Scorelist instance as a common parent 
-	# for all Score instances to be able to use ancestor 
-	# queries and thus avoid problems with the High
-	# Replication data store
-	@classmethod
-	def single_key(cls):
-		single_scorelist = Scorelist(key_name="all_scores")
-		single_scorelist.put()
-		return single_scorelist.key()
-
+from country import Country
+from histogram import PointsHistogram
+from lrucache import LRUCache
+from toplist import PageIndex, TopList, WindowTopList, merge_lists
 
-class Score( db.Model ):
+class Score( object ):
 	SUBMIT_FAIL = 0
 	SUBMIT_SUCCESS = 1
 	# Like success, except the score already existed. Safe. :)
 	SUBMIT_SKIPPED = 2
 	
-	name = db.StringProperty( required=True, multiline=False )
-	comment = db.StringProperty( multiline=False, default="" )
-	points = db.IntegerProperty( required=True )
-	control = db.StringProperty( required=True, multiline=False )
-	location = db.StringProperty( required=True, multiline=False )
-	date = db.DateTimeProperty( auto_now_add=True )
-	new_week = db.BooleanProperty( required=True, default=True )
+	# Fresh TopLists by list key, in front of memcache. An instance trusts
+	# them for config.LOCAL_LIST_CACHE_TTL seconds and keeps them up to date
+	# with its own submits and invalidations, other instances' changes show
+	# up when they expire.
+	_local_lists = LRUCache( config.LOCAL_LIST_CACHE_SIZE,
+		config.LOCAL_LIST_CACHE_TTL )
+	# Lists made by get_non_national_list, which nothing keeps up to date, so
+	# they are only trusted for as long.
+	_non_national_lists = LRUCache( config.LOCAL_LIST_CACHE_SIZE,
+		config.LOCAL_LIST_CACHE_TTL )
+	
+	def __init__( self, name, points, control, location, comment="",
+			date=None, new_week=True, key=None,
+			game_mode=config.DEFAULT_GAME_MODE, player_id=None ):
+		self.name = name
+		self.comment = comment
+		self.points = points
+		self.control = control
+		self.game_mode = game_mode
+		self.location = location
+		if date is None:
+			date = datetime.datetime.now()
+		self.date = date
+		self.new_week = new_week
+		# The android id of the player, only kept on boards that keep
+		# personal bests.
+		self.player_id = player_id
+		# Set by the backend once the score is stored.
+		self.key = key
+	
+	@classmethod
+	def board_name( cls, control, game_mode=config.DEFAULT_GAME_MODE ):
+		"""Return the name of the leaderboard of control and game_mode,
+		which is what lists, caches and stored scores are kept apart by. For
+		the default game mode it is the control."""
+		if game_mode == config.DEFAULT_GAME_MODE:
+			return control
+		return "%s/%s" % ( control, game_mode )
+	
+	@classmethod
+	def split_board( cls, board ):
+		"""Return a tuple ( control, game mode ) of the board name."""
+		control, separator, game_mode = board.partition( "/" )
+		return control, game_mode or config.DEFAULT_GAME_MODE
+	
+	@classmethod
+	def boards( cls ):
+		"""Return the names of all valid leaderboards."""
+		return [ cls.board_name( control, game_mode )
+			for game_mode in config.VALID_GAME_MODES
+			for control in config.VALID_CONTROLS ]
+	
+	@classmethod
+	def list_length( cls, board ):
+		"""Return the length of the top lists of board."""
+		return config.GAME_MODE_LIST_LENGTHS.get( cls.split_board( board )[1],
+			config.TOP_LIST_LENGTH )
+	
+	@classmethod
+	def keeps_personal_bests( cls, board ):
+		"""Return whether board keeps only the best score of each player,
+		see config.PERSONAL_BEST_GAME_MODES."""
+		return cls.split_board( board )[1] in config.PERSONAL_BEST_GAME_MODES
+	
+	@property
+	def board( self ):
+		return self.board_name( self.control, self.game_mode )
+	
+	@property
+	def player( self ):
+		"""The player the score is by, its player_id if it has one and
+		otherwise its name."""
+		if self.player_id is not None:
+			return self.player_id
+		return self.name
+	
+	def identity( self ):
+		"""Return a hex digest of what makes two scores the same: name,
+		comment, points and board, or on boards that keep personal bests the
+		player and board."""
+		if self.keeps_personal_bests( self.board ):
+			parts = [ u"player", self.player, self.board ]
+		else:
+			parts = [ self.name, self.comment, unicode( self.points ),
+				self.board ]
+		return hashlib.sha1( u"\0".join( parts ).encode( "utf-8" ) ) \
+			.hexdigest()
 	
 	def equals( self, other ):
 		return self.name == other.name \
 			and self.comment == other.comment \
 			and self.points == other.points \
-			and self.control == other.control \
+			and self.board == other.board \
 			and self.location == other.location
 	
 	def to_dict(self):
@@ -82,32 +151,227 @@ class Score( db.Model ):
 		return d
 	
 	@classmethod
-	def submit( cls, name, comment, points, control, location ):
+	def submit( cls, name, comment, points, control, location,
+			game_mode=config.DEFAULT_GAME_MODE, player_id=None ):
+		"""Submit one score, see submit_many."""
+		score = {
+			"name": name,
+			"comment": comment,
+			"points": points,
+			"control": control,
+			"game_mode": game_mode,
+		}
+		return cls.submit_many( [ score ], location, player_id )[0]
+	
+	@classmethod
+	def submit_many( cls, scores, location, player_id=None ):
+		"""Submit a list of score dicts with name, comment, points, control
+		and optionally game_mode, all made in location by the player with the
+		android id player_id, if known. Return a list with the SUBMIT_*
+		status of each. Scores without a game_mode are of
+		config.DEFAULT_GAME_MODE.
+		
+		The whole batch costs two list lookups per board, one batch lookup
+		and one put in the store, and one multi get and compare-and-set of the
+		cached lists.
+		
+		On boards that keep personal bests, a score instead replaces the
+		stored best of its player, see Score.player, only if it has more
+		points, in one keyed read-modify-write per score. Every player's best
+		is kept, not only the ones that show up, so that the ranks count
+		players.
+		
+		"""
+		statuses = [ Score.SUBMIT_FAIL ] * len( scores )
+		
+		candidates = []
+		for i, score in enumerate( scores ):
+			new_score = cls._validate( score["name"], score["comment"],
+				score["points"], score["control"], location,
+				score.get( "game_mode", config.DEFAULT_GAME_MODE ), player_id )
+			if new_score is not None:
+				candidates.append( ( i, new_score ) )
+		
+		# Look up the lowest points that show up once per board, then
+		# filter the whole batch against them.
+		lowest_visible = {}
+		for i, new_score in candidates:
+			if new_score.board in lowest_visible:
+				continue
+			if cls.keeps_personal_bests( new_score.board ):
+				# Every player's best is kept, so that the ranks count players.
+				lowest_visible[new_score.board] = 0
+			else:
+				lowest_visible[new_score.board] = cls._lowest_visible_points(
+					location, new_score.board )
+		
+		# Scores that wouldn't show up are still counted for the ranks, see
+		# get_rank.
+		to_insert = []
+		to_best = []
+		invisible = []
+		for i, new_score in candidates:
+			if new_score.points < lowest_visible[new_score.board]:
+				logging.info( "Score.submit: Score wouldn't show up on " \
+					+ "neither it's location list (%s) nor the week list, " \
+					+ "skip saving. (%s, %s, %d)", location, new_score.name,
+					new_score.comment, new_score.points )
+				statuses[i] = Score.SUBMIT_SKIPPED
+				invisible.append( new_score )
+			elif cls.keeps_personal_bests( new_score.board ):
+				to_best.append( ( i, new_score ) )
+			else:
+				to_insert.append( ( i, new_score ) )
+		
+		# Insert unless there is an identical score, from any time. If there
+		# is, then SUCCEDE silently.
+		inserted = []
+		if len( to_insert ) > 0:
+			try:	
+				inserted = backend.get().insert_scores(
+					[ new_score for i, new_score in to_insert ] )
+			except Exception, e:
+				logging.error( "Score.submit: Got exception when putting " \
+					+ "scores to the datastore. Type: %s, msg: %s", type( e ),
+					e )
+		
+		bests = []
+		if len( to_best ) > 0:
+			try:
+				bests = backend.get().put_personal_bests(
+					[ new_score for i, new_score in to_best ] )
+			except Exception, e:
+				logging.error( "Score.submit: Got exception when putting " \
+					+ "personal bests to the datastore. Type: %s, msg: %s",
+					type( e ), e )
+		
+		new_scores = []
+		for ( i, new_score ), was_inserted in zip( to_insert, inserted ):
+			if was_inserted:
+				statuses[i] = Score.SUBMIT_SUCCESS
+				new_scores.append( new_score )
+			else:
+				logging.info("Score.submit: Score already exists, skip " \
+					+ "saving. (%s, %s, %d)", new_score.name,
+					new_score.comment, new_score.points )
+				statuses[i] = Score.SUBMIT_SKIPPED
+		
+		# The scores the new bests replaced, in the same order.
+		replaced = [ None ] * len( new_scores )
+		for ( i, new_score ), ( was_stored, old_score ) in zip( to_best,
+				bests ):
+			if was_stored:
+				statuses[i] = Score.SUBMIT_SUCCESS
+				new_scores.append( new_score )
+				replaced.append( old_score )
+			else:
+				logging.info( "Score.submit: Score doesn't beat the best of " \
+					+ "its player, skip saving. (%s, %s, %d)", new_score.name,
+					new_score.comment, new_score.points )
+				statuses[i] = Score.SUBMIT_SKIPPED
+		
+		cls._count_in_histograms( cls._not_yet_counted( invisible )
+			+ new_scores )
+		cls._count_in_histograms( [ old_score for old_score in replaced
+			if old_score is not None ], -1 )
+		
+		if len( new_scores ) == 0:
+			return statuses
+		
+		# Save the location of the submit.
+		try:
+			Country.save( location )
+		except Exception, msg:
+			logging.warning( "Score.submit: Got exception when saving " \
+				+ "location: '%s'", msg )
+		
+		cls._add_to_cached_lists( location, new_scores, replaced )
+		
+		return statuses
+	
+	@classmethod
+	def _points_by_list( cls, scores ):
+		"""Return a dict of ( board, location ) to the list of points of
+		the scores of it."""
+		points_by_list = {}
+		for score in scores:
+			points_by_list.setdefault( ( score.board, score.location ),
+				[] ).append( score.points )
+		return points_by_list
+	
+	@classmethod
+	def _not_yet_counted( cls, scores ):
+		"""Return those of the skipped scores that aren't counted in the rank
+		histograms yet, and mark them as counted.
+		
+		Skipped scores aren't stored, so the store can't tell a resent one
+		apart. The marks are only kept for config.RANK_HISTOGRAM_COUNTED_TIME
+		and, like the rest of memcache, can be evicted, so a resent score may
+		still be counted twice. Without memcache none are counted.
+		
+		"""
+		if len( scores ) == 0:
+			return []
+		
+		marks = dict( ( "counted:%s" % score.identity(), score )
+			for score in scores )
+		already_counted = backend.get().cache_add_multi( dict.fromkeys( marks, 1 ),
+			time=config.RANK_HISTOGRAM_COUNTED_TIME )
+		return [ score for mark, score in marks.iteritems()
+			if not mark in already_counted ]
+	
+	@classmethod
+	def _count_in_histograms( cls, scores, count=1 ):
+		"""Count scores count times in the rank histograms, -1 to take
+		them back. Only logs failures, the ranks are estimates anyway."""
+		for ( board, location ), points in cls._points_by_list(
+				scores ).iteritems():
+			try:
+				backend.get().add_to_histograms( board, location, points,
+					count )
+			except Exception, e:
+				logging.warning( "Score._count_in_histograms: Got exception " \
+					+ "when counting %d scores of %s:%s. Type: %s, msg: %s",
+					len( points ), board, location, type( e ), e )
+	
+	@classmethod
+	def _validate( cls, name, comment, points, control, location,
+			game_mode=config.DEFAULT_GAME_MODE, player_id=None ):
+		"""Return a new Score, with name and comment truncated to the allowed
+		lengths, or None if the values aren't valid. player_id is only kept
+		on boards that keep personal bests, and only if it is valid."""
+		
 		# Check that the control is valid.
 		if not control in config.VALID_CONTROLS:
 			logging.error( "Score.submit: invalid control \"%s\"", control )
-			return Score.SUBMIT_FAIL
+			return None
+		
+		# Check that the game mode is valid.
+		if not game_mode in config.VALID_GAME_MODES:
+			logging.error( "Score.submit: invalid game mode \"%s\"",
+				game_mode )
+			return None
 		
 		# Check that we got a name.
 		if name == "":
 			logging.error("Score.submit: got empty name")
-			return Score.SUBMIT_FAIL
+			return None
 		
 		# Check that we got points.
 		if points == "":
 			logging.error( "Score.submit: got empty points" )
-			return Score.SUBMIT_FAIL
+			return None
 		# Catch the cases where points is not a number.
 		try:
 			points = int( points )
 		except ValueError:
 			logging.error( "Score.submit: points not an int" )
-			return Score.SUBMIT_FAIL
+			return None
 		# Check that points >= 0.
 		if points < 0:
 			logging.error( "Score.submit: points has to be >= 0 but was %d",
 				points )
-			return Score.SUBMIT_FAIL
+			return None
 		
 		# Check the length of the name.
 		if len(name) > config.SCORE_NAME_MAX_LENGTH:
@@ -126,247 +390,350 @@ class Score( db.Model ):
 		# Check the location.
 		if location == "":
 			logging.error( "Score.submit: Got invalid location \"\"" )
-			return Score.SUBMIT_FAIL
-		
-		if not cls._would_show_on_location_or_week_lists( location, points,
-				control ):
-			logging.info( "Score.submit: Score wouldn't show up on neither " \
-				+ "it's location list (%s) nor the week list, skip saving. " \
-				+ "(%s, %s, %d)", location, name, comment, points )
-			return Score.SUBMIT_SKIPPED
-		else:
-			logging.info( "Score.submit: Score would show up, continuing. " \
-				+ "(%s, %s, %d)", name, comment, points )
+			return None
 		
-		# Check if there is an identical score, from any time. If there is, then
-		# SUCCEDE silently.
-		if cls._already_exists( name, comment, points, control ):
-			logging.info("Score.submit: Score already exists, skip saving. "
-				+ "(%s, %s, %d)", name, comment, points )
-			return Score.SUBMIT_SKIPPED
+		# Check the player id, telling the player apart by name without one.
+		if not cls.keeps_personal_bests( cls.board_name( control,
+				game_mode ) ):
+			player_id = None
+		elif player_id is not None and ( not isinstance( player_id,
+				basestring ) or player_id == ""
+				or len( player_id ) > config.PLAYER_ID_MAX_LENGTH ):
+			logging.warning( "Score.submit: Got invalid player id %s, " \
+				+ "using the name.", repr( player_id ) )
+			player_id = None
 		
 		try:
-			new_score = Score( name=name,
+			return Score( name=name,
 				comment=comment,
 				points=points,
 				control=control,
-				location=location,
-				parent=Scorelist.single_key())
+				location=location,
+				game_mode=game_mode,
+				player_id=player_id )
 		except Exception, e:
 			logging.error( "Score.submit: Got exception when creating Score " \
-				+ "model object. Type: %s, msg: %s", type( e ), e )
-			return Score.SUBMIT_FAIL
-		
-		try:	
-			new_score.put()
-		except Exception, e:
-			logging.error( "Score.submit: Got exception when putting score " \
-				+ "to the datastore. Type: %s, msg: %s", type( e ), e )
-			return Score.SUBMIT_FAIL
-		
-		# Save the location of the submit.
-		try:
-			Country.save( location )
-		except Exception, msg:
-			logging.warning( "Score.submit: Got exception when saving " \
-				+ "location: '%s'", msg )
-		
-		cls._delete_cached_list_if_invalid( control, location, points )
-		cls._delete_cached_list_if_invalid( control, config.LOCATION_WORLD,
-			points )
-		cls._delete_cached_list_if_invalid( control, config.LOCATION_WEEK,
-			points )
-		
-		return Score.SUBMIT_SUCCESS
+				+ "object. Type: %s, msg: %s", type( e ), e )
+			return None
 	
 	@classmethod
-	def _already_exists( cls, name, comment, points, control ):
-		scores = Score.all().ancestor(Scorelist.single_key()) \
-			.filter( "name =", name ) \
-			.filter( "comment =", comment ) \
-			.filter( "points =", points ) \
-			.filter( "control =", control )
-		fetched = scores.fetch( 100 )
+	def _leaderboard_points( cls, board, location ):
+		"""Return the points of the config.LEADERBOARD_LENGTH:th score of
+		board and location, or None if there are fewer scores. Cached for
+		config.LEADERBOARD_POINTS_CACHE_TIME seconds once there are enough
+		scores."""
+		points_key = "leaderboardpoints:%s:%s" % ( board, location )
+		points = backend.get().cache_get( points_key )
+		if points is not None:
+			return points
 		
-		return len( fetched ) > 0
+		points = backend.get().nth_points( board, location,
+			config.LEADERBOARD_LENGTH )
+		if points is not None:
+			backend.get().cache_set( points_key, points,
+				time=config.LEADERBOARD_POINTS_CACHE_TIME )
+		return points
 	
 	@classmethod
-	def _would_show_on_location_or_week_lists( cls, location, points, control ):
-		"""Return whether or not a score with this number of points would show
-		up on it's location list or the week list."""
+	def _lowest_visible_points( cls, location, board ):
+		"""Return the lowest number of points a score needs to show up on
+		a page of it's location, see get_page, or on the week list."""
 		
-		location_list = cls.get_top_list( config.TOP_LIST_LENGTH, control,
-			location )
-		week_list = cls.get_top_list( config.TOP_LIST_LENGTH, control,
+		week_list = cls.get_top_list( cls.list_length( board ), board,
 			config.LOCATION_WEEK )
+		if not week_list.is_full():
+			return 0
 		
-		if location_list[1] < config.TOP_LIST_LENGTH \
-				or week_list[1] < config.TOP_LIST_LENGTH:
-			return True
+		location_low_score = cls._leaderboard_points( board, location )
+		if location_low_score is None:
+			return 0
 		
-		location_low_score = location_list[2]
-		week_low_score = week_list[2]
+		week_low_score = week_list.lowest_points
 		lowest_low_score = min( location_low_score, week_low_score )
 		
-		logging.info( "Score._would_show_on_location_or_week_lists: " \
+		logging.info( "Score._lowest_visible_points: " \
 			+ "location_low_score=%d, week_low_score=%d, lowest_low_score=%d",
 			location_low_score, week_low_score, lowest_low_score )
 		
-		return points >= lowest_low_score
+		return lowest_low_score
+	
+	@classmethod
+	def _flag_new_week( cls, new_week ):
+		"""Return a BatchUpdate function that sets new_week on the scores
+		that don't have it set that way already."""
+		def update( scores ):
+			changed = [ score for score in scores
+				if score.new_week != new_week ]
+			for score in changed:
+				score.new_week = new_week
+			return changed
+		return update
 	
 	@classmethod
 	def deep_reflag_new_week( cls ):
-		"""Reflag all scores (maximum 1000)."""
-		
-		# Flag all new true.
-		scores = Score.all().ancestor(Scorelist.single_key())
-		scores = scores.order( "-date" )
+		"""Reflag all scores, going through every stored score. Return the
+		number of scores changed. Resumes where an interrupted run stopped,
+		see BatchUpdate."""
 		
 		time_delta = datetime.timedelta( seconds=config.WEEK_LIST_TIME )
 		now = datetime.datetime.now()
 		start_of_period = now - time_delta
 		
-		scores = scores.filter( "date >", start_of_period )
-		fetched = scores.fetch( 1000 )
-		
-		for f in fetched:
-			f.new_week = True
-		
-		db.put( fetched )
+		# Flag all new true.
+		changed = BatchUpdate( "deep_reflag_new", {
+			"date_after": start_of_period,
+			"order": "-date",
+		}, cls._flag_new_week( True ) ).run()
 		
 		# Flag all old false.
-		scores = Score.all().ancestor(Scorelist.single_key())
+		changed += BatchUpdate( "deep_reflag_old", {
+			"date_before": start_of_period,
+			"order": "-date",
+		}, cls._flag_new_week( False ) ).run()
 		
-		scores = scores.order( "-date" )
-		
-		time_delta = datetime.timedelta( seconds=config.WEEK_LIST_TIME )
-		now = datetime.datetime.now()
-		start_of_period = now - time_delta
-		
-		scores = scores.filter( "date <", start_of_period )
-		
-		fetched = scores.fetch( 1000 )
-		
-		for f in fetched:
-			f.new_week = False
-		
-		db.put( fetched )
+		return changed
 	
 	@classmethod
 	def reflag_new_week( cls ):
 		"""Set scores with new_week = True to new_week = False if they are older
-		than one week"""
-		
-		scores = Score.all().ancestor(Scorelist.single_key()) \
-            .filter( "new_week =", True )
-		
-		scores = scores.order( "-date" )
+		than one week. Return the number of scores changed. Resumes where an
+		interrupted run stopped, see BatchUpdate."""
 		
 		time_delta = datetime.timedelta( seconds=config.WEEK_LIST_TIME )
 		now = datetime.datetime.now()
 		start_of_period = now - time_delta
 		
-		scores = scores.filter( "date <", start_of_period )
-		fetched = scores.fetch( 1000 )
+		return BatchUpdate( "reflag_new_week", {
+			"new_week": True,
+			"date_before": start_of_period,
+			"order": "-date",
+		}, cls._flag_new_week( False ) ).run()
+	
+	@classmethod
+	def seed_histograms( cls ):
+		"""Count the stored scores in the rank histograms, replacing what
+		they counted before, so that scores stored before there were
+		histograms are ranked too. Return the number of scores counted.
 		
-		# Make sure we don't try to put more than 500 at a time since
-		# that will cause a crash (gae won't allow it).
-		while len( fetched ) > 100:
-			to_put, fetched = fetched[:100], fetched[100:]
-			
-			for f in to_put:
-				f.new_week = False
-			db.put( to_put )
+		A new run clears the histograms and counts the scores dated before
+		it started, the ones submitted since are counted as they come in. An
+		interrupted run is resumed by the next one, see BatchUpdate, which
+		counts a page twice if the interruption came between counting it and
+		its checkpoint.
 		
-		# Put the last bit.
-		if len( fetched ) > 0:
-			for f in fetched:
-				f.new_week = False
-			db.put( fetched )
+		"""
+		counted = [ 0 ]
+		def count( scores ):
+			for ( board, location ), points in cls._points_by_list(
+					scores ).iteritems():
+				backend.get().add_to_histograms( board, location, points )
+			counted[0] += len( scores )
+			return []
+		
+		update = BatchUpdate( "seed_histograms", {
+			"date_before": datetime.datetime.now(),
+			"order": "-date",
+		}, count )
+		if not update.resuming():
+			locations = Country.all()
+			for board in cls.boards():
+				backend.get().clear_histograms( board, locations )
+		update.run()
+		
+		return counted[0]
 	
 	@classmethod
-	def _get_top_raw( cls, count, control, location ):
-		"""Fetch the top #count scores for the control and location directly
-		from the store.
+	def _get_top_raw( cls, count, board, locations ):
+		"""Fetch the top #count scores for the board and each of the
+		locations directly from the store, with the queries running in
+		parallel.
 		
-		Retuns a possibly empty list of Model entities.
+		Retuns a list with a possibly empty list of Score objects per
+		location.
 		
 		"""
 		
 		if not isinstance( count, int ) or count <= 0:
 			raise ValueError( "count has to be an integer > 0" )
 		
-		if not control in config.VALID_CONTROLS:
-			raise ValueError( "Invalid control \"%s\"" % control )
-		
-		scores = Score.all().ancestor(Scorelist.single_key()) \
-            .filter( "control =", control )		
-
-		if not location in ( config.LOCATION_WORLD, config.LOCATION_WEEK ):
-			scores = scores.filter( "location =", location )
-		
-		if location == config.LOCATION_WEEK:
-			scores = scores.filter( "new_week =", True )
-		
-		scores = scores.order( "-points" )
-		fetched = scores.fetch( count )
+		if not board in cls.boards():
+			raise ValueError( "Invalid board \"%s\"" % board )
 		
-		return fetched
+		return backend.get().top_scores_multi( count, board, locations )
 	
 	@classmethod
-	def _cache_list( cls, control, location, list_json, length,
-			lowest_score_points ):
-		"""Cache a list as a tuple of (cached list json, list length, lowest
-		score points)."""
-		list_key = "list:%s:%s" % ( control, location )
-		value = ( list_json, length, lowest_score_points )
-		memcache.set( list_key, value )
+	def _list_key( cls, board, location ):
+		return "list:%s:%s" % ( board, location )
 	
 	@classmethod
-	def _get_cached_list( cls, control, location ):
-		"""Return a tuple of (cached list json, list length, lowest score
-		points)."""
-		list_key = "list:%s:%s" % ( control, location )
-		cached_value = memcache.get( list_key )
-		return cached_value
+	def _generation_key( cls, board, location ):
+		return "listgen:%s:%s" % ( board, location )
 	
 	@classmethod
-	def _delete_cached_list_if_invalid( cls, control, location, points ):
-		list_key = "list:%s:%s" % ( control, location )
-		cached_value = memcache.get( list_key )
-		if cached_value is not None:
-			cached_json, length, lowest_score_points = cached_value
-		else:
-			return
+	def _lease_key( cls, board, location ):
+		return "listlease:%s:%s" % ( board, location )
+	
+	@classmethod
+	def _cache_lists( cls, board, top_lists ):
+		"""Cache TopLists of board."""
+		mapping = dict( ( cls._list_key( board, top_list.location ),
+			top_list ) for top_list in top_lists )
+		backend.get().cache_set_multi( mapping )
 		
-		if length < config.TOP_LIST_LENGTH or points >= lowest_score_points:
-			m = memcache.delete( list_key )
+		for list_key, top_list in mapping.iteritems():
+			size, compressed_size = top_list.sizes()
+			logging.info( "Score._cache_lists: %s is %d bytes, %d compressed " \
+				+ "(%.0f%%).", list_key, size, compressed_size,
+				100.0 * compressed_size / max( size, 1 ) )
+		for list_key, top_list in mapping.iteritems():
+			cls._local_lists.set( list_key, top_list )
 	
 	@classmethod
-	def _delete_cached_list( cls, control, location ):
-		list_key = "list:%s:%s" % ( control, location )
-		result = memcache.delete( list_key )
-		if result == 0:
-			logging.error( "Score._delete_cached_list: Failed to delete " \
-				+ "memcache key \"%s\", got network error!", list_key )
-		elif result == 1:
-			logging.info( "Score._delete_cached_list: Memcache key \"%s\" " \
-				+ "doesn't exist, nothing deleted.", list_key )
-		elif result == 2:
-			logging.info( "Score._delete_cached_list: Memcache key \"%s\" " \
-				+ "successfully deleted.", list_key )
+	def _get_cached_lists( cls, board, locations ):
+		"""Return a dict of location to ( cached TopList or None, current
+		generation ) for the locations. Lists in the instance cache cost
+		nothing, the rest are fetched from memcache in one go."""
+		found = {}
+		remote = []
+		for location in locations:
+			top_list = cls._local_lists.get( cls._list_key( board,
+				location ) )
+			if top_list is not None:
+				top_list.expire()
+				found[location] = ( top_list, top_list.generation )
+			else:
+				remote.append( location )
+		
+		if len( remote ) == 0:
+			return found
+		
+		list_keys = [ cls._list_key( board, location )
+			for location in remote ]
+		generation_keys = [ cls._generation_key( board, location )
+			for location in remote ]
+		cached = backend.get().cache_get_multi( list_keys + generation_keys )
+		
+		for location, list_key, generation_key in zip( remote, list_keys,
+				generation_keys ):
+			top_list = cached.get( list_key )
+			if not isinstance( top_list, TopList ):
+				top_list = None
+			else:
+				top_list.expire()
+			# Counters made by incr can come back as strings.
+			generation = int( cached.get( generation_key, 0 ) )
+			found[location] = ( top_list, generation )
+			
+			if top_list is not None and top_list.generation == generation:
+				cls._local_lists.set( list_key, top_list )
+		return found
+	
+	@classmethod
+	def _add_to_cached_lists( cls, location, scores, replaced=None ):
+		"""Splice newly stored scores from location into the cached location,
+		world and week lists they make it onto, using one multi get and one
+		multi compare-and-set. Lists that aren't cached are left alone, the
+		next get_top_list builds them from the store, with the scores.
+		
+		replaced is a list with the personal best each of the scores
+		replaced, or None, see submit_many. They are taken off the lists the
+		new scores go onto, and the lists of other locations they were on are
+		rebuilt.
+		
+		"""
+		
+		if replaced is None:
+			replaced = [ None ] * len( scores )
+		
+		# list key -> ( board, list location, [ ( score dict, replaced
+		# score dict ) ] )
+		lists = {}
+		for score, old_score in zip( scores, replaced ):
+			old_dict = None
+			if old_score is not None:
+				old_dict = old_score.to_dict()
+				# Taking the old score off the list of another location would
+				# leave that list a score short.
+				if old_score.location != location:
+					cls._invalidate_cached_list( score.board,
+						old_score.location )
+			
+			for list_location in ( location, config.LOCATION_WORLD,
+					config.LOCATION_WEEK ):
+				list_key = cls._list_key( score.board, list_location )
+				if not list_key in lists:
+					lists[list_key] = ( score.board, list_location, [] )
+				lists[list_key][2].append( ( score.to_dict(), old_dict ) )
+		
+		pending = lists.keys()
+		for attempt in range( config.CACHE_CAS_RETRIES ):
+			cached = backend.get().cache_gets_multi( pending )
+			
+			changed = {}
+			for list_key, top_list in cached.iteritems():
+				if not isinstance( top_list, TopList ):
+					continue
+				for score_dict, old_dict in lists[list_key][2]:
+					if old_dict is None:
+						was_changed = top_list.insert( score_dict )
+					else:
+						was_changed = top_list.replace( old_dict, score_dict )
+					if was_changed:
+						changed[list_key] = top_list
+			
+			if len( changed ) == 0:
+				return
+			
+			pending = backend.get().cache_cas_multi( changed )
+			
+			# Keep the instance cache's copies, which are fresh, up to date.
+			for list_key, top_list in changed.iteritems():
+				local_list = cls._local_lists.get( list_key )
+				if not list_key in pending and local_list is not None \
+						and local_list.generation == top_list.generation:
+					cls._local_lists.set( list_key, top_list )
+			
+			if len( pending ) == 0:
+				return
+		
+		for list_key in pending:
+			logging.warning( "Score._add_to_cached_lists: Lost the race for " \
+				+ "\"%s\" %d times, deleting it.", list_key,
+				config.CACHE_CAS_RETRIES )
+			board, list_location, score_dicts = lists[list_key]
+			cls._invalidate_cached_list( board, list_location )
 	
 	@classmethod
-	def get_top_list( cls, count, control, location ):
-		"""Return a tuple (json_dump, length, lowest_points) where json_dump is
-		a dump of a json object containing information about a top list, length
-		is the number of scores in the list and lowest_points is the number of
-		points of the worst score in the list.
+	def _invalidate_cached_list( cls, board, location ):
+		"""Make the cached list stale by moving on to the next generation.
+		The stale list stays cached and is served until one request has
+		rebuilt it."""
+		cls._local_lists.delete( cls._list_key( board, location ) )
+		
+		generation_key = cls._generation_key( board, location )
+		generation = backend.get().cache_incr( generation_key,
+			initial_value=0 )
+		if generation is None:
+			logging.error( "Score._invalidate_cached_list: Failed to " \
+				+ "increment memcache key \"%s\", got network error!",
+				generation_key )
+		else:
+			logging.info( "Score._invalidate_cached_list: List %s:%s is " \
+				+ "now at generation %d.", board, location, generation )
+	
+	@classmethod
+	def get_top_list( cls, count, board, location ):
+		"""Return a TopList. Its to_json() is a dump of a json object
+		containing information about a top list, its length is the number of
+		scores in the list and its lowest_points is the number of points of the
+		worst score in the list.
 		
 		Parameters:
-		count - The number of entries in the list. Only used when building a new
-			list, ignored when returning a cached list.
-		control - The control type of the list to retrieve.
+		count - The most entries in the list. Lists of up to list_length
+			scores are cut from the cached lists, longer ones are read with
+			get_page, except for the week list, which is never longer than
+			list_length.
+		board - The leaderboard of the list to retrieve, see board_name.
 		location - The location of a list to retrieve. Can be a country code,
 			config.LOCATION_WEEK or config.LOCATION_WORLD.
 		
@@ -388,55 +755,421 @@ class Score( db.Model ):
 		
 		"""
 		
-		# Check for a cached list and return it if we get one.
-		cached_list = cls._get_cached_list( control, location )
-		if not cached_list is None:
-			logging.info( "get_top_list: Returning cached list." )
-			return cached_list
-		
-		# Get a raw list of scores from the datastore.
-		raw_list = cls._get_top_raw( count, control, location )
-		logging.info( "get_top_list: Raw list length is %d" % len( raw_list ) )
-		# Get the last placed score.
-		last_place = None
-		try:
-			last_place = raw_list[-1]
-		except IndexError:
-			pass
+		return cls.get_top_lists( count, board, [ location ] )[0]
+	
+	@classmethod
+	def get_top_lists( cls, count, board, locations ):
+		"""Return a list with the TopList of each of the locations, see
+		get_top_list.
 		
-		dict_scores = []
-		for score in raw_list:
-			dict_scores.append( score.to_dict() )
+		All the cached lists are fetched with one multi get, and the lists
+		that aren't cached are built from the store with their queries running
+		in parallel, so a miss costs about as much as the slowest query.
 		
-		prepped_for_json = {
-			"location": location,
-			"scores": dict_scores,
-		}
-		dumped_json = json.dumps( prepped_for_json )
+		A list is only rebuilt by the request that gets its lease. Other
+		requests get the stale list while it is rebuilt, and wait for the
+		rebuilt list if there is nothing cached at all.
+		
+		"""
+		
+		if not isinstance( count, int ) or count <= 0:
+			raise ValueError( "count has to be an integer > 0" )
+		
+		top_lists = cls._get_full_lists( board, locations )
+		
+		fitted = []
+		for location, top_list in zip( locations, top_lists ):
+			if count > cls.list_length( board ) \
+					and location != config.LOCATION_WEEK:
+				top_list = TopList( location, count, cls.get_page( board,
+					location, 0, count ) )
+			fitted.append( top_list.head( count ) )
+		return fitted
+	
+	@classmethod
+	def _get_full_lists( cls, board, locations ):
+		"""Return a list with the cached list_length long TopList of each
+		of the locations, see get_top_lists."""
+		
+		cached = cls._get_cached_lists( board, locations )
+		
+		top_lists = {}
+		generations = {}
+		stale = []
+		for location in locations:
+			top_list, generation = cached[location]
+			generations[location] = generation
+			if top_list is not None:
+				top_lists[location] = top_list
+				if top_list.generation != generation:
+					stale.append( location )
+			else:
+				stale.append( location )
+		
+		logging.info( "get_top_lists: Got %d of %d lists fresh from cache.",
+			len( locations ) - len( stale ), len( locations ) )
+		
+		if len( stale ) == 0:
+			return [ top_lists[location] for location in locations ]
+		
+		# Lists with a stale copy are only rebuilt by whoever gets the lease.
+		# For the ones with nothing cached, keep waiting for the holder and
+		# try to take over the lease, which expires if the holder died,
+		# until a whole lease time has passed.
+		started = time.time()
+		unleased = stale
+		while True:
+			leases = dict( ( cls._lease_key( board, location ), location )
+				for location in unleased )
+			not_leased = backend.get().cache_add_multi(
+				dict.fromkeys( leases, 1 ), time=config.LIST_LEASE_TIME )
+			leased = [ leases[lease_key] for lease_key in leases
+				if not lease_key in not_leased ]
+			# A failed add, like when memcache is down, also reports the key as
+			# not set. Only wait for leases that someone really holds, and
+			# build the other missing lists right away, without a lease.
+			held = backend.get().cache_get_multi( not_leased ) \
+				if len( not_leased ) > 0 else {}
+			unheld = [ leases[lease_key] for lease_key in not_leased
+				if not lease_key in held
+				and not leases[lease_key] in top_lists ]
+			waiting = [ leases[lease_key] for lease_key in held
+				if not leases[lease_key] in top_lists ]
+			
+			if len( leased ) + len( unheld ) > 0:
+				for top_list in cls._build_lists( board, leased + unheld,
+						generations ):
+					top_lists[top_list.location] = top_list
+				backend.get().cache_delete_multi( [ cls._lease_key( board,
+					location ) for location in leased ] )
+			
+			if len( waiting ) == 0:
+				break
+			
+			if time.time() - started >= config.LIST_LEASE_TIME:
+				# Only when memcache keeps failing, build the rest without a
+				# lease.
+				logging.warning( "get_top_lists: Gave up waiting for %s.",
+					", ".join( waiting ) )
+				for top_list in cls._build_lists( board, waiting,
+						generations ):
+					top_lists[top_list.location] = top_list
+				break
+			
+			waited = cls._wait_for_lists( board, waiting )
+			top_lists.update( waited )
+			unleased = [ location for location in waiting
+				if not location in waited ]
+			if len( unleased ) == 0:
+				break
+		
+		return [ top_lists[location] for location in locations ]
+	
+	@classmethod
+	def _build_lists( cls, board, locations, generations ):
+		"""Build and cache the lists of locations from the store, stamped
+		with their generation in generations. Return a list of TopLists.
+		
+		The world list is merged last, from the country lists built here and
+		the cached ones of the other countries, so that a request never waits
+		for a list it holds the lease of itself.
+		
+		"""
+		
+		count = cls.list_length( board )
+		
+		# Get raw lists of scores from the datastore. The week list is built
+		# from the best scores of each day of the week, see WindowTopList, and
+		# the world list from the country lists, see _merge_country_lists.
+		top_locations = [ location for location in locations
+			if not location in ( config.LOCATION_WEEK,
+			config.LOCATION_WORLD ) ]
+		raw_lists = dict( zip( top_locations, cls._get_top_raw( count,
+			board, top_locations ) ) )
+		
+		built = []
+		for location in locations:
+			if location == config.LOCATION_WEEK:
+				since = datetime.datetime.now() \
+					- datetime.timedelta( seconds=config.WEEK_LIST_TIME )
+				recent = backend.get().recent_top_scores( count, board,
+					since )
+				logging.info( "get_top_lists: %d of the best scores of the " \
+					+ "days of the week", len( recent ) )
+				built.append( WindowTopList( location, count,
+					config.WEEK_LIST_TIME,
+					[ score.to_dict() for score in recent ],
+					generations[location] ) )
+				continue
+			
+			if location == config.LOCATION_WORLD:
+				continue
+			
+			raw_list = raw_lists[location]
+			logging.info( "get_top_lists: Raw list length for %s is %d",
+				location, len( raw_list ) )
+			dict_scores = [ score.to_dict() for score in raw_list ]
+			built.append( TopList( location, count, dict_scores,
+				generations[location] ) )
+		
+		if len( built ) > 0:
+			cls._cache_lists( board, built )
+		
+		if config.LOCATION_WORLD in locations:
+			world_list = cls._merge_country_lists( board,
+				generations[config.LOCATION_WORLD],
+				dict( ( top_list.location, top_list ) for top_list in built ) )
+			cls._cache_lists( board, [ world_list ] )
+			built.append( world_list )
 		
-		# Figure out the last place points.
-		if last_place is None:
-			last_place_points = 0
+		return built
+	
+	@classmethod
+	def _merge_country_lists( cls, board, generation, known=None ):
+		"""Build the world TopList of board, stamped with generation, by
+		merging the lists of all saved countries, which every score on it is
+		on too. known is a dict of location to TopList with country lists to
+		use as they are. The others come from the cache like in
+		get_top_lists, so this only touches the store for the ones that
+		aren't cached."""
+		if known is None:
+			known = {}
+		
+		countries = Country.all()
+		missing = [ country for country in countries
+			if not country in known ]
+		fetched = {}
+		if len( missing ) > 0:
+			fetched = dict( zip( missing, cls._get_full_lists( board,
+				missing ) ) )
+		fetched.update( known )
+		country_lists = [ fetched[country] for country in countries ]
+		
+		logging.info( "get_top_lists: Merging the world list from %d " \
+			+ "country lists", len( country_lists ) )
+		return merge_lists( config.LOCATION_WORLD, cls.list_length( board ),
+			country_lists, generation )
+	
+	@classmethod
+	def get_non_national_list( cls, board, location ):
+		"""Return a TopList of config.LOCATION_NON_NATIONAL with the best
+		scores of board from everywhere but location, see get_top_list.
+		
+		It is made from cached lists rather than queried: if no score from
+		location is on the world list, it is the world list, otherwise it is
+		merged from the lists of all the other countries. Either way it is
+		kept by the instance for config.LOCAL_LIST_CACHE_TTL seconds.
+		
+		"""
+		
+		list_key = cls._list_key( board, "%s:%s" % (
+			config.LOCATION_NON_NATIONAL, location ) )
+		top_list = cls._non_national_lists.get( list_key )
+		if top_list is not None:
+			return top_list
+		
+		world_list = cls._get_full_lists( board,
+			[ config.LOCATION_WORLD ] )[0]
+		if all( score_dict["location"] != location
+				for score_dict in world_list.scores ):
+			top_list = TopList( config.LOCATION_NON_NATIONAL,
+				cls.list_length( board ), world_list.scores )
 		else:
-			last_place_points = last_place.points
+			countries = [ country for country in Country.all()
+				if country != location ]
+			country_lists = []
+			if len( countries ) > 0:
+				country_lists = cls._get_full_lists( board, countries )
+			top_list = merge_lists( config.LOCATION_NON_NATIONAL,
+				cls.list_length( board ), country_lists )
 		
-		#save the json list and the last placed points to the memcache
-		cls._cache_list( control, location, dumped_json, len( raw_list ),
-			last_place_points )
+		cls._non_national_lists.set( list_key, top_list )
+		return top_list
+	
+	@classmethod
+	def _wait_for_lists( cls, board, locations ):
+		"""Wait up to config.LIST_LEASE_WAIT seconds for other requests to
+		cache the lists of locations. Return a dict of location to TopList
+		for the ones that showed up in time."""
 		
-		return ( dumped_json, len( raw_list ), last_place_points )
+		found = {}
+		waited = 0.0
+		while waited < config.LIST_LEASE_WAIT and len( found ) < len(
+				locations ):
+			time.sleep( 0.05 )
+			waited += 0.05
+			
+			missing = [ location for location in locations
+				if not location in found ]
+			for location, ( top_list, generation ) in cls._get_cached_lists(
+					board, missing ).iteritems():
+				if top_list is not None:
+					found[location] = top_list
+		
+		return found
+	
+	@classmethod
+	def _page_index_key( cls, board, location ):
+		return "pageindex:%s:%s" % ( board, location )
 	
 	@classmethod
-	def get_lowest_score( cls, control, location ):
-		"""Get the lowest score for control and location from memcache."""
+	def _get_page_index( cls, board, location ):
+		"""Return the PageIndex of the list of board and location, which
+		is a country code or config.LOCATION_WORLD, from memcache when
+		cached."""
+		index_key = cls._page_index_key( board, location )
+		index = backend.get().cache_get( index_key )
+		if isinstance( index, PageIndex ):
+			return index
 		
-		cached_list = Score._get_cached_list( control, location )
-		if cached_list is None:
-			return None
+		location_filter = location
+		if location == config.LOCATION_WORLD:
+			location_filter = None
+		
+		index = PageIndex( location, config.PAGE_INDEX_STEP )
+		cursor = None
+		while len( index ) < config.LEADERBOARD_LENGTH:
+			scores, cursor = backend.get().query_scores_page( cursor,
+				board=board, location=location_filter, order="-points",
+				limit=config.PAGE_INDEX_STEP )
+			index.add_page( [ score.points for score in scores ], cursor )
+			if cursor is None:
+				break
+		
+		logging.info( "Score._get_page_index: Indexed %d scores of %s:%s.",
+			len( index ), board, location )
+		backend.get().cache_set( index_key, index,
+			time=config.PAGE_INDEX_CACHE_TIME )
+		return index
+	
+	@classmethod
+	def get_page( cls, board, location, offset, limit ):
+		"""Return a list of the score dicts, as in get_top_list, of at most
+		limit scores from the list of board and location, starting after
+		the first offset scores. Lists go down to config.LEADERBOARD_LENGTH
+		scores, except for the week list, which goes down to list_length.
+		
+		Pages within the top list are cut from it. Deeper pages are read from
+		the store, starting at the closest cursor of the page index of the
+		list at or before offset, so they cost at most
+		config.PAGE_INDEX_STEP scores more than limit to read however deep
+		they are.
+		
+		"""
+		
+		if not isinstance( offset, int ) or offset < 0:
+			raise ValueError( "offset has to be an integer >= 0" )
+		if not isinstance( limit, int ) or limit <= 0:
+			raise ValueError( "limit has to be an integer > 0" )
+		
+		limit = min( limit, config.LEADERBOARD_LENGTH - offset )
+		if limit <= 0:
+			return []
+		
+		if location == config.LOCATION_WEEK \
+				or offset + limit <= cls.list_length( board ):
+			top_list = cls._get_full_lists( board, [ location ] )[0]
+			return top_list.scores[offset:offset + limit]
+		
+		# Lists that were still short when their index was built go on after
+		# its last cursor.
+		index = cls._get_page_index( board, location )
+		
+		location_filter = location
+		if location == config.LOCATION_WORLD:
+			location_filter = None
+		
+		start, cursor = index.start( offset )
+		scores = backend.get().query_scores_page( cursor, board=board,
+			location=location_filter, order="-points",
+			limit=offset - start + limit )[0]
+		return [ score.to_dict() for score in scores[offset - start:] ]
+	
+	@classmethod
+	def get_page_around( cls, board, location, points, limit ):
+		"""Return a tuple ( offset, scores ) with the get_page of at most
+		limit scores of the list of board and location that is centered on
+		where a score with points would be, or the last page if it wouldn't
+		make it onto the list."""
+		
+		top_list = cls._get_full_lists( board, [ location ] )[0]
+		if top_list.qualifies( points ) or location == config.LOCATION_WEEK:
+			better = top_list.count_above( points )
+			length = top_list.length
 		else:
-			lowest_score = cached_list[2]
-			try:
-				lowest_scrore = int( lowest_score )
-			except:
-				return None
-			return lowest_score
+			index = cls._get_page_index( board, location )
+			better = index.count_above( points )
+			length = len( index )
+		
+		offset = max( 0, min( better - limit // 2, length - limit ) )
+		return offset, cls.get_page( board, location, offset, limit )
+	
+	@classmethod
+	def _histogram_key( cls, board, location ):
+		return "rankhist:%s:%s" % ( board, location )
+	
+	@classmethod
+	def _get_histograms( cls, board, locations ):
+		"""Return a dict with the PointsHistogram of each of the locations,
+		from memcache when cached."""
+		keys = dict( ( cls._histogram_key( board, location ), location )
+			for location in locations )
+		cached = backend.get().cache_get_multi( keys.keys() )
+		
+		histograms = {}
+		to_cache = {}
+		for key, location in keys.iteritems():
+			if key in cached:
+				histograms[location] = PointsHistogram.loads( cached[key] )
+			else:
+				histogram = backend.get().histogram( board, location )
+				histograms[location] = histogram
+				to_cache[key] = histogram.dumps()
+		
+		if to_cache:
+			backend.get().cache_set_multi( to_cache,
+				time=config.RANK_HISTOGRAM_CACHE_TIME )
+		
+		return histograms
+	
+	@classmethod
+	def get_rank( cls, points, board, location ):
+		"""Return a tuple ( rank, percentile ) for a score with points on the
+		list of board and location, which is a country code or
+		config.LOCATION_WORLD.
+		
+		rank is one more than the number of scores with more points, and
+		percentile is the percentage of all submitted scores that have at most
+		as many points. Ranks on the top list are exact. Further down they are
+		estimated from a histogram of the points of every score submitted, the
+		ones that were never stored included, and may be up to
+		config.RANK_HISTOGRAM_CACHE_TIME seconds behind.
+		
+		"""
+		
+		return cls.get_ranks( points, board, [ location ] )[0]
+	
+	@classmethod
+	def get_ranks( cls, points, board, locations ):
+		"""Return a list with the get_rank of points for each of the
+		locations."""
+		top_lists = cls.get_top_lists( cls.list_length( board ), board,
+			locations )
+		histograms = cls._get_histograms( board, locations )
+		
+		ranks = []
+		for location, top_list in zip( locations, top_lists ):
+			histogram = histograms[location]
+			if top_list.qualifies( points ):
+				better = top_list.count_above( points )
+			else:
+				# Everything on the list is better, whatever the cached
+				# histogram says.
+				better = max( histogram.count_above( points ),
+					top_list.length )
+			
+			total = max( histogram.total, better + 1 )
+			ranks.append( ( better + 1,
+				100.0 * ( total - better ) / total ) )
+		
+		return ranks
@@ -0,0 +1,417 @@
+# coding=utf-8
+
+# Copyright (c) 2013 Sebastian Ärleryd
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import compact
+import hashlib
+import heapq
+import itertools
+import json
+import time
+import zlib
+
+class _NegatedPoints( object ):
+	"""Ascending view of the points of a descending list of score dicts, for
+	bisecting."""
+	
+	def __init__( self, scores ):
+		self._scores = scores
+	
+	def __len__( self ):
+		return len( self._scores )
+	
+	def __getitem__( self, i ):
+		return -self._scores[i]["points"]
+
+
+class PageIndex( object ):
+	"""The points of the scores of a list, down to some rank, with a store
+	cursor for every step'th rank, see Score.get_page. Built a page at a time
+	with add_page."""
+	
+	def __init__( self, location, step ):
+		self.location = location
+		self.step = step
+		# Negated, so that they are ascending for bisecting.
+		self._negated = []
+		# The cursor of the page starting at rank i * step + 1.
+		self._cursors = [ None ]
+	
+	def __len__( self ):
+		return len( self._negated )
+	
+	@property
+	def lowest_points( self ):
+		if len( self._negated ) == 0:
+			return 0
+		return -self._negated[-1]
+	
+	def add_page( self, points, cursor ):
+		"""Add the descending points of a page of step scores following the
+		ones added before, and the cursor of the next page or None."""
+		self._negated.extend( -p for p in points )
+		if cursor is not None:
+			self._cursors.append( cursor )
+	
+	def count_above( self, points ):
+		"""Return the number of indexed scores with more points than
+		points."""
+		return bisect.bisect_left( self._negated, -points )
+	
+	def start( self, offset ):
+		"""Return a tuple ( start, cursor ) with the cursor of the last page
+		that starts at the offset'th score or before, and the offset of its
+		first score."""
+		page = min( offset // self.step, len( self._cursors ) - 1 )
+		return page * self.step, self._cursors[page]
+
+
+class TopList( object ):
+	"""A top list of score dicts (see Score.to_dict) sorted by descending
+	points, holding at most capacity scores.
+	
+	The list is kept as its json dump, which is what requests need, and the
+	score dicts are only decoded when a score is inserted. Pickling keeps
+	just the dump, zlib compressed, which takes care of the key names
+	repeated for every score. The dump is only decompressed when it is
+	needed, which it isn't for checking the summary or the etag.
+	
+	generation is the cache generation of the list the TopList was built
+	for, see Score.get_top_lists.
+	
+	"""
+	
+	def __init__( self, location, capacity, scores=(), generation=0 ):
+		self.location = location
+		self.capacity = capacity
+		self.generation = generation
+		self._scores = list( scores )[:capacity]
+		self._changed()
+		self._update_summary()
+	
+	def __len__( self ):
+		return self.length
+	
+	def __getstate__( self ):
+		return {
+			"location": self.location,
+			"capacity": self.capacity,
+			"generation": self.generation,
+			"length": self.length,
+			"lowest_points": self.lowest_points,
+			"json_z": self._compressed(),
+			"etag": self.etag(),
+		}
+	
+	def __setstate__( self, state ):
+		self.location = state["location"]
+		self.capacity = state["capacity"]
+		self.generation = state["generation"]
+		self.length = state["length"]
+		self.lowest_points = state["lowest_points"]
+		# Lists pickled by older versions have the plain json and no etag.
+		self._json = state.get( "json" )
+		self._json_z = state.get( "json_z" )
+		self._etag = state.get( "etag" )
+		self._compact = None
+		self._scores = None
+	
+	def _changed( self ):
+		"""Forget the dumps of the list, after changing it."""
+		self._json = None
+		self._json_z = None
+		self._etag = None
+		self._compact = None
+	
+	def _compressed( self ):
+		if self._json_z is None:
+			self._json_z = zlib.compress( self.to_json(), 6 )
+		return self._json_z
+	
+	def sizes( self ):
+		"""Return a tuple ( json size, compressed size ) in bytes."""
+		return len( self.to_json() ), len( self._compressed() )
+	
+	def _update_summary( self ):
+		self.length = len( self._scores )
+		if self._scores:
+			self.lowest_points = self._scores[-1]["points"]
+		else:
+			self.lowest_points = 0
+	
+	@property
+	def scores( self ):
+		if self._scores is None:
+			self._scores = json.loads( self.to_json() )["scores"]
+		return self._scores
+	
+	def is_full( self ):
+		return self.length >= self.capacity
+	
+	def qualifies( self, points ):
+		"""Return whether a score with points would make it onto the list."""
+		return not self.is_full() or points >= self.lowest_points
+	
+	def expire( self, now=None ):
+		"""Drop the scores that are too old for the list. Return whether the
+		list changed. A plain TopList never drops anything."""
+		return False
+	
+	def count_above( self, points ):
+		"""Return the number of scores on the list with more points than
+		points."""
+		if self.length == 0 or points >= self.scores[0]["points"]:
+			return 0
+		return bisect.bisect_left( _NegatedPoints( self.scores ), -points )
+	
+	def insert( self, score_dict ):
+		"""Splice score_dict into the list, after any scores with the same
+		points, dropping the last score if the list overflows. Return
+		whether the list changed."""
+		points = score_dict["points"]
+		if not self.qualifies( points ):
+			return False
+		
+		scores = self.scores
+		negated = _NegatedPoints( scores )
+		first = bisect.bisect_left( negated, -points )
+		last = bisect.bisect_right( negated, -points )
+		
+		# The score may already be on the list if the list was rebuilt from
+		# the store after the score was put.
+		if score_dict in scores[first:last]:
+			return False
+		
+		# A full list only qualifies ties of its last score, which would go
+		# in after them and fall right off.
+		if last >= self.capacity:
+			return False
+		
+		scores.insert( last, score_dict )
+		del scores[self.capacity:]
+		self._changed()
+		self._update_summary()
+		return True
+	
+	def replace( self, old_dict, score_dict ):
+		"""Splice score_dict into the list in place of old_dict, a score
+		with fewer points that it replaced in the store. Return whether the
+		list changed.
+		
+		A full list that old_dict is on has room for score_dict once old_dict
+		is gone, so nothing else drops off it.
+		
+		"""
+		scores = self.scores
+		if not old_dict in scores:
+			return self.insert( score_dict )
+		
+		scores.remove( old_dict )
+		self._changed()
+		self._update_summary()
+		self.insert( score_dict )
+		return True
+	
+	def to_json( self ):
+		"""Return the list as a json dump of the form
+		{
+			"location": <location>,
+			"scores": [score_dict1, score_dict2, ...]
+		}
+		"""
+		if self._json is None and self._json_z is not None:
+			self._json = zlib.decompress( self._json_z )
+		elif self._json is None:
+			self._json = json.dumps( {
+				"location": self.location,
+				"scores": self._scores,
+			}, separators=( ",", ":" ) )
+		return self._json
+	
+	def to_compact( self ):
+		"""Return the list encoded with compact.encode_list. The encoding
+		isn't pickled, but kept for as long as the TopList is."""
+		if self._compact is None:
+			self._compact = compact.encode_list( self.location, self.scores )
+		return self._compact
+	
+	def head( self, count ):
+		"""Return this list if it holds at most count scores, otherwise an
+		uncached TopList of at most its first count scores."""
+		if self.capacity <= count:
+			return self
+		return TopList( self.location, count, self.scores[:count],
+			self.generation )
+	
+	def etag( self ):
+		"""Return a short hash of to_json(), for clients to tell whether the
+		list they have is still current."""
+		if self._etag is None:
+			self._etag = hashlib.md5( self.to_json() ).hexdigest()[:16]
+		return self._etag
+
+
+def _merge_keys( i, scores ):
+	for j, score_dict in enumerate( scores ):
+		yield -score_dict["points"], score_dict["date"], i, j, score_dict
+
+def merge_lists( location, capacity, top_lists, generation=0 ):
+	"""Return a TopList of location with the first capacity scores of the
+	TopLists top_lists, by a k-way merge that only looks at as many scores
+	of them as end up on the merged list. Scores with the same points are
+	taken oldest first."""
+	merged = heapq.merge( *[ _merge_keys( i, top_list.scores )
+		for i, top_list in enumerate( top_lists ) ] )
+	return TopList( location, capacity, [ keys[-1] for keys
+		in itertools.islice( merged, capacity ) ], generation )
+
+
+class WindowTopList( TopList ):
+	"""A TopList of only the scores dated within the last window seconds,
+	which is exact at any time without rewriting anything in the store.
+	
+	Besides the scores on the list it keeps as candidates every score that
+	can still make it onto the list as older scores expire: those that have
+	fewer than capacity newer scores with more points. A new score always is
+	one, and may push out older candidates with fewer points. The list is the
+	first capacity candidates, and the candidates are dropped once they are
+	older than window. The time of the next expiry is kept apart so that
+	checking for it doesn't need the candidates decoded.
+	
+	"""
+	
+	def __init__( self, location, capacity, window, scores=(), generation=0,
+			now=None ):
+		TopList.__init__( self, location, capacity, (), generation )
+		self.window = window
+		# Oldest first among scores with the same points, like insert does.
+		self._candidates = sorted( scores, key=lambda score_dict: (
+			-score_dict["points"], score_dict["date"] ) )
+		self._candidates_z = None
+		self._refresh( now )
+	
+	def __getstate__( self ):
+		state = TopList.__getstate__( self )
+		if self._candidates_z is None:
+			self._candidates_z = zlib.compress( json.dumps( self._candidates,
+				separators=( ",", ":" ) ), 6 )
+		state.update( {
+			"window": self.window,
+			"next_expiry": self.next_expiry,
+			"candidates_z": self._candidates_z,
+		} )
+		return state
+	
+	def __setstate__( self, state ):
+		TopList.__setstate__( self, state )
+		self.window = state["window"]
+		self.next_expiry = state["next_expiry"]
+		self._candidates_z = state["candidates_z"]
+		self._candidates = None
+	
+	@property
+	def candidates( self ):
+		if self._candidates is None:
+			self._candidates = json.loads( zlib.decompress(
+				self._candidates_z ) )
+		return self._candidates
+	
+	def _refresh( self, now=None ):
+		"""Drop expired and hopeless candidates and update the list from
+		the rest."""
+		if now is None:
+			now = time.time()
+		oldest = now - self.window
+		
+		# Walk the candidates from the most points down, keeping the sorted
+		# dates of the kept ones with more points than the current one.
+		kept = []
+		better_dates = []
+		candidates = [ score_dict for score_dict in self.candidates
+			if score_dict["date"] > oldest ]
+		i = 0
+		while i < len( candidates ):
+			points = candidates[i]["points"]
+			same = i
+			while same < len( candidates ) \
+					and candidates[same]["points"] == points:
+				same += 1
+			
+			group = candidates[i:same]
+			for score_dict in group:
+				newer = len( better_dates ) - bisect.bisect_right(
+					better_dates, score_dict["date"] )
+				if newer < self.capacity:
+					kept.append( score_dict )
+			for score_dict in group:
+				bisect.insort( better_dates, score_dict["date"] )
+			i = same
+		
+		if kept:
+			self.next_expiry = min( score_dict["date"]
+				for score_dict in kept ) + self.window
+		else:
+			self.next_expiry = None
+		
+		self._candidates = kept
+		self._candidates_z = None
+		self._scores = kept[:self.capacity]
+		self._changed()
+		self._update_summary()
+	
+	def expire( self, now=None ):
+		if now is None:
+			now = time.time()
+		if self.next_expiry is None or self.next_expiry > now:
+			return False
+		self._refresh( now )
+		return True
+	
+	def insert( self, score_dict ):
+		"""Add score_dict to the candidates. Return whether it is one, which
+		is whether the list changed now or may later."""
+		self.expire()
+		
+		candidates = self.candidates
+		negated = _NegatedPoints( candidates )
+		first = bisect.bisect_left( negated, -score_dict["points"] )
+		last = bisect.bisect_right( negated, -score_dict["points"] )
+		if score_dict in candidates[first:last]:
+			return False
+		
+		candidates.insert( last, score_dict )
+		self._refresh()
+		return score_dict in self._candidates
+	
+	def replace( self, old_dict, score_dict ):
+		"""Like insert, but first drops old_dict, a score with fewer points
+		that score_dict replaced in the store, from the candidates. Newer
+		scores with more points than a candidate stay at least as many, so no
+		dropped candidate has to come back."""
+		candidates = self.candidates
+		if not old_dict in candidates:
+			return self.insert( score_dict )
+		
+		candidates.remove( old_dict )
+		self._refresh()
+		self.insert( score_dict )
+		return True